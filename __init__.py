@@ -1,5 +1,9 @@
 import bpy
-from bpy.props import StringProperty, BoolProperty, IntProperty, PointerProperty
+import time
+from concurrent.futures import ThreadPoolExecutor
+import os
+from bpy.props import StringProperty, BoolProperty, IntProperty, FloatProperty, PointerProperty, CollectionProperty
+from . import k2_keys
 
 bl_info = {
     "name": "K2 Model/Animation Import-Export",
@@ -14,8 +18,136 @@ bl_info = {
     "category": "Import-Export"
 }
 
+# Add-on preferences
+class K2Preferences(bpy.types.AddonPreferences):
+    bl_idname = __name__
+
+    cache_directory: StringProperty(
+        name="Cache Directory",
+        description="Where decoded models and clips are cached, empty for the user cache directory",
+        subtype='DIR_PATH',
+        default=""
+    )
+    cache_size: IntProperty(
+        name="Cache Size (MB)",
+        description="Least recently used entries are removed once the cache grows past this size",
+        default=1024,
+        min=1
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "cache_directory")
+        layout.prop(self, "cache_size")
+
+def decode_cache(context):
+    from . import k2_cache
+    prefs = context.preferences.addons[__name__].preferences
+    directory = bpy.path.abspath(prefs.cache_directory) if prefs.cache_directory else None
+    return k2_cache.DecodeCache(directory, prefs.cache_size * 1024 * 1024)
+
+def report_timing(operator, trace):
+    for line in trace.summary_lines():
+        operator.report({'INFO'}, line)
+    if operator.timing_file:
+        trace.write_json(bpy.path.abspath(operator.timing_file))
+
+def report_clips(operator, imported):
+    for clip in imported:
+        removed = 100 * (1 - clip.keys / clip.samples) if clip.samples else 0
+        operator.report({'INFO'}, f"{clip.name}: {clip.keys} of {clip.samples} keys, {removed:.1f}% removed")
+    operator.report({'INFO'}, f"{len(imported)} clip(s) imported")
+
+# Modal part of the importers. The file is decoded on a worker thread, then
+# the data-blocks are built from a timer a slice at a time so the UI stays
+# responsive. Esc removes everything the import created so far.
+# decode is a static method called with the plain values passed to
+# start_modal: the worker thread must not touch the operator, which may be
+# freed while it still runs.
+class K2ModalImport:
+    time_slice = 0.05
+
+    def start_modal(self, context, trace_name, *decode_args):
+        from . import k2_import, k2_trace
+        self._trace = k2_trace.begin_trace(trace_name)
+        self._snapshot = k2_import.snapshot_ids()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = self._executor.submit(self.decode, *decode_args)
+        self._steps = None
+        self._phase = None
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.02, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        context.workspace.status_text_set(f"{self.bl_label}: decoding (Esc to cancel)")
+        return {'RUNNING_MODAL'}
+
+    def end_modal(self, context):
+        from . import k2_trace
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        self._executor.shutdown(wait=False)
+        k2_trace.end_trace(self._trace)
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, "Import cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        try:
+            if self._steps is None:
+                if not self._future.done():
+                    return {'PASS_THROUGH'}
+                data = self._future.result()
+                if data is None:
+                    self.end_modal(context)
+                    self.report({'ERROR'}, f"Could not read {self.filepath}")
+                    return {'CANCELLED'}
+                self._steps = self.build_steps(context, data)
+
+            deadline = time.perf_counter() + self.time_slice
+            while time.perf_counter() < deadline:
+                phase, done, total = next(self._steps)
+        except StopIteration as e:
+            self.end_modal(context)
+            self._result = e.value
+            self.finish(context)
+            if self.report_timing:
+                report_timing(self, self._trace)
+            return {'FINISHED'}
+        except Exception as e:
+            self.cancel(context)
+            self.report({'ERROR'}, f"Import failed: {e}")
+            return {'CANCELLED'}
+
+        wm = context.window_manager
+        if phase != self._phase:
+            # One progress bar per phase
+            wm.progress_end()
+            wm.progress_begin(0, 100)
+            self._phase = phase
+        wm.progress_update(int(100 * done / max(total, 1)))
+        context.workspace.status_text_set(f"{self.bl_label}: {phase} {done}/{total} (Esc to cancel)")
+        return {'RUNNING_MODAL'}
+
+    def cancel(self, context):
+        from . import k2_import
+        self.end_modal(context)
+        if self._steps is not None:
+            self._steps.close()
+        k2_import.remove_new_ids(self._snapshot)
+        self.rollback(context)
+
+    def rollback(self, context):
+        pass
+
 # Operator for importing K2/Silverlight clip data
-class K2ImporterClip(bpy.types.Operator):
+class K2ImporterClip(K2ModalImport, bpy.types.Operator):
     """Load K2/Silverlight clip data"""
     bl_idname = "import_clip.k2"
     bl_label = "Import K2 Clip"
@@ -23,21 +155,131 @@ class K2ImporterClip(bpy.types.Operator):
     filepath: StringProperty(
         subtype='FILE_PATH'
     )
+    files: CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'}
+    )
+    directory: StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'}
+    )
     filter_glob: StringProperty(
         default="*.clip", options={'HIDDEN'}
     )
+    use_nla: BoolProperty(
+        name="Stack as NLA Strips",
+        description="Place the imported clips back to back as strips of one NLA track",
+        default=False
+    )
+    keep_actions: BoolProperty(
+        name="Keep Actions",
+        description="Give every imported action a fake user so clips that are not in use are kept when saving",
+        default=True
+    )
+    reduce_keys: BoolProperty(
+        name="Reduce Keys",
+        description="Drop keys that linear interpolation reproduces within the tolerances, "
+                    "constant channels get a single key",
+        default=False
+    )
+    location_tolerance: FloatProperty(
+        name="Location Tolerance",
+        description="Largest location error of a dropped key",
+        default=k2_keys.LOCATION_TOLERANCE, min=0.0, precision=5
+    )
+    rotation_tolerance: FloatProperty(
+        name="Rotation Tolerance",
+        description="Largest rotation error of a dropped key",
+        subtype='ANGLE',
+        default=k2_keys.ROTATION_TOLERANCE, min=0.0
+    )
+    use_cache: BoolProperty(
+        name="Use Cache",
+        description="Reuse decoded clip data from the cache when the file has not changed",
+        default=False
+    )
+    report_timing: BoolProperty(
+        name="Report Timing",
+        description="Report how long each import phase took",
+        default=False
+    )
+    timing_file: StringProperty(
+        name="Timing File",
+        description="Also write the timing spans to this JSON file",
+        subtype='FILE_PATH',
+        default=""
+    )
+    non_blocking: BoolProperty(
+        name="Non-blocking",
+        description="When started from the file browser, import in the background with a progress bar, Esc cancels the import",
+        default=True
+    )
+    # Set by invoke, script calls of execute always import synchronously
+    invoked: BoolProperty(
+        default=False, options={'HIDDEN', 'SKIP_SAVE'}
+    )
+
+    def filepaths(self):
+        paths = [os.path.join(self.directory, f.name) for f in self.files if f.name]
+        return paths or [self.filepath]
+
+    def tolerances(self):
+        if not self.reduce_keys:
+            return None
+        return self.location_tolerance, self.rotation_tolerance
 
     def execute(self, context):
-        from . import k2_import
-        k2_import.readclip(self.filepath)
+        from . import k2_import, k2_trace
+        self._cache = decode_cache(context) if self.use_cache else None
+        if self.invoked and self.non_blocking and not bpy.app.background and context.window is not None:
+            if not context.selected_objects:
+                self.report({'ERROR'}, "No object selected")
+                return {'CANCELLED'}
+            self._arm_ob = context.selected_objects[0]
+            anim = self._arm_ob.animation_data
+            self._previous_action = anim.action if anim else None
+            self._previous_tracks = {track.name for track in anim.nla_tracks} if anim else set()
+            named_paths = [(bpy.path.display_name_from_filepath(path), path) for path in self.filepaths()]
+            return self.start_modal(context, 'Clip import', named_paths, self._cache)
+        with k2_trace.tracing('Clip import') as trace:
+            imported = k2_import.readclips(self.filepaths(), self._cache, self.use_nla, self.keep_actions,
+                                           self.tolerances())
+        report_clips(self, imported)
+        if self.report_timing:
+            report_timing(self, trace)
         return {'FINISHED'}
 
+    @staticmethod
+    def decode(named_paths, cache):
+        from . import k2_import
+        clips = []
+        for name, filepath in named_paths:
+            clip = k2_import.load_clip_data(filepath, cache)
+            if clip is not None:
+                clips.append((name, clip))
+        return clips or None
+
+    def build_steps(self, context, clips):
+        from . import k2_import
+        return k2_import.build_clips_steps(clips, self._arm_ob, self.use_nla, self.keep_actions, self.tolerances())
+
+    def finish(self, context):
+        report_clips(self, self._result)
+
+    def rollback(self, context):
+        anim = self._arm_ob.animation_data
+        if anim:
+            for track in [track for track in anim.nla_tracks if track.name not in self._previous_tracks]:
+                anim.nla_tracks.remove(track)
+            anim.action = self._previous_action
+
     def invoke(self, context, event):
+        self.invoked = True
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
 # Operator for importing K2/Silverlight mesh data
-class K2Importer(bpy.types.Operator):
+class K2Importer(K2ModalImport, bpy.types.Operator):
     """Load K2/Silverlight mesh data"""
     bl_idname = "import_mesh.k2"
     bl_label = "Import K2 Mesh"
@@ -53,10 +295,55 @@ class K2Importer(bpy.types.Operator):
         description="Flip UV",
         default=True
     )
+    use_cache: BoolProperty(
+        name="Use Cache",
+        description="Reuse decoded model data from the cache when the file has not changed",
+        default=False
+    )
+    report_timing: BoolProperty(
+        name="Report Timing",
+        description="Report how long each import phase took",
+        default=False
+    )
+    timing_file: StringProperty(
+        name="Timing File",
+        description="Also write the timing spans to this JSON file",
+        subtype='FILE_PATH',
+        default=""
+    )
+    non_blocking: BoolProperty(
+        name="Non-blocking",
+        description="When started from the file browser, import in the background with a progress bar, Esc cancels the import",
+        default=True
+    )
+    # Set by invoke, script calls of execute always import synchronously
+    invoked: BoolProperty(
+        default=False, options={'HIDDEN', 'SKIP_SAVE'}
+    )
 
-    def execute(self, context):
+    @staticmethod
+    def decode(filepath, flipuv, cache):
         from . import k2_import
-        k2_import.read(self.filepath, self.flipuv)
+        return k2_import.load_model_data(filepath, flipuv, cache)
+
+    def build_steps(self, context, data):
+        from . import k2_import
+        objname = bpy.path.display_name_from_filepath(self.filepath)
+        return k2_import.build_model_steps(data, objname)
+
+    def finish(self, context):
+        from . import k2_import
+        k2_import.view_all_in_3d_view()
+
+    def execute(self, context):
+        from . import k2_import, k2_trace
+        self._cache = decode_cache(context) if self.use_cache else None
+        if self.invoked and self.non_blocking and not bpy.app.background and context.window is not None:
+            return self.start_modal(context, 'Model import', self.filepath, self.flipuv, self._cache)
+        with k2_trace.tracing('Model import') as trace:
+            k2_import.read(self.filepath, self.flipuv, self._cache)
+        if self.report_timing:
+            report_timing(self, trace)
 
         # Create a special context that includes VIEW_3D type areas and regions
         found_view3d = False
@@ -89,6 +376,7 @@ class K2Importer(bpy.types.Operator):
         return {'FINISHED'}
 
     def invoke(self, context, event):
+        self.invoked = True
         context.window_manager.fileselect_add(self)
         return {'RUNNING_MODAL'}
 
@@ -125,12 +413,18 @@ class K2ClipExporter(bpy.types.Operator):
         description="Ending frame for the animation",
         default=250
     )
+    sample_action: BoolProperty(
+        name="Sample Action Only",
+        description="Evaluate the armature's action directly instead of updating the whole scene for every frame. Constraints and drivers are ignored",
+        default=False
+    )
 
     def execute(self, context):
         from . import k2_export
         k2_export.export_k2_clip(
             self.filepath, self.apply_modifiers,
-            self.frame_start, self.frame_end
+            self.frame_start, self.frame_end,
+            self.sample_action
         )
         return {'FINISHED'}
 
@@ -163,10 +457,46 @@ class K2MeshExporter(bpy.types.Operator):
         description="Use transformed mesh data from each object",
         default=True
     )
+    optimize_cache: BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder triangles and vertices for post-transform vertex cache reuse",
+        default=False
+    )
+    lod_ratios: StringProperty(
+        name="LOD Ratios",
+        description="Comma-separated triangle ratios of extra LOD models written next to the main one as <name>_lod1.model, <name>_lod2.model, ... (e.g. 0.5, 0.25)",
+        default=""
+    )
+    max_influences: IntProperty(
+        name="Max Influences",
+        description="Bone influences kept per vertex, the strongest ones win and the weights are renormalized",
+        default=4,
+        min=1,
+        max=16
+    )
+    weight_threshold: FloatProperty(
+        name="Weight Threshold",
+        description="Bone weights below this are dropped before limiting and renormalizing",
+        default=0.01,
+        min=0.0,
+        max=1.0
+    )
 
     def execute(self, context):
         from . import k2_export
-        k2_export.export_k2_mesh(self.filepath, self.apply_modifiers)
+        try:
+            lod_ratios = [float(r) for r in self.lod_ratios.replace(',', ' ').split()]
+        except ValueError:
+            self.report({'ERROR'}, "LOD ratios must be numbers separated by commas")
+            return {'CANCELLED'}
+        if any(not 0.0 < r <= 1.0 for r in lod_ratios):
+            self.report({'ERROR'}, "LOD ratios must be between 0 and 1")
+            return {'CANCELLED'}
+        k2_export.export_k2_mesh(
+            self.filepath, self.apply_modifiers,
+            self.optimize_cache, lod_ratios, self.report,
+            self.max_influences, self.weight_threshold
+        )
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -237,6 +567,7 @@ class K2ExportSettings(bpy.types.PropertyGroup):
 
 # Register the add-on
 def register():
+    bpy.utils.register_class(K2Preferences)
     bpy.utils.register_class(K2ImporterClip)
     bpy.utils.register_class(K2Importer)
     bpy.utils.register_class(K2ClipExporter)
@@ -256,6 +587,7 @@ def unregister():
     bpy.utils.unregister_class(K2_PT_ImportExportPanel)
     bpy.utils.unregister_class(K2ImportSettings)
     bpy.utils.unregister_class(K2ExportSettings)
+    bpy.utils.unregister_class(K2Preferences)
     del bpy.types.Scene.k2_import_settings
     del bpy.types.Scene.k2_export_settings
 
@@ -0,0 +1,219 @@
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Headless batch conversion of .model/.clip trees.
+#
+# Driver, run with any Python 3:
+#   python k2_batch.py SRC DST --blender /path/to/blender --workers 8
+# It shards the files under SRC across background Blender processes and keeps
+# a resumable job list (DST/k2_batch_jobs.json by default). Every worker runs
+#   blender -b --factory-startup --python k2_batch.py -- --worker SRC DST FILE...
+# and reimports/reexports each file with the add-on's own importer/exporter.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import k2_files
+
+ADDON_MODULE = 'k2_blender_batch'
+STATUS_PREFIX = 'K2BATCH '
+
+##############################
+# WORKER (inside Blender)
+##############################
+
+def load_addon():
+    path = os.path.dirname(os.path.abspath(__file__))
+    if ADDON_MODULE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(ADDON_MODULE, os.path.join(path, '__init__.py'), submodule_search_locations=[path])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[ADDON_MODULE] = module
+        spec.loader.exec_module(module)
+    return importlib.import_module(f'{ADDON_MODULE}.k2_import'), importlib.import_module(f'{ADDON_MODULE}.k2_export')
+
+def reset_scene():
+    import bpy
+    bpy.ops.wm.read_homefile(use_empty=True)
+
+def find_rig_model(clip_path, root):
+    # HoN keeps clips next to or below the model they animate
+    directory = os.path.dirname(os.path.abspath(clip_path))
+    root = os.path.abspath(root)
+    while True:
+        models = sorted(f for f in os.listdir(directory) if f.lower().endswith('.model'))
+        if models:
+            return os.path.join(directory, models[0])
+        if directory == root or os.path.dirname(directory) == directory:
+            return None
+        directory = os.path.dirname(directory)
+
+def import_model(k2_import, src):
+    # k2_import.read only logs failures, decode first so they fail the file
+    import bpy
+    data = k2_import.load_model_data(src, True)
+    if data is None:
+        raise RuntimeError(f'{src} is not a K2 model')
+    k2_import.build_model(data, bpy.path.display_name_from_filepath(src))
+    if not bpy.context.scene.objects:
+        raise RuntimeError(f'{src} has no meshes or bones')
+
+def convert_model(k2_import, k2_export, src, dst):
+    reset_scene()
+    import_model(k2_import, src)
+    k2_export.export_k2_mesh(dst, False)
+
+def convert_clip(k2_import, k2_export, src, dst, root):
+    import bpy
+    rig_model = find_rig_model(src, root)
+    if rig_model is None:
+        raise RuntimeError('no .model found for clip')
+    reset_scene()
+    import_model(k2_import, rig_model)
+    rigs = [obj for obj in bpy.context.scene.objects if obj.type == 'ARMATURE']
+    if not rigs:
+        raise RuntimeError(f'{rig_model} has no skeleton')
+    for obj in bpy.context.scene.objects:
+        obj.select_set(obj == rigs[0])
+    k2_import.readclip(src)
+    action = rigs[0].animation_data.action if rigs[0].animation_data else None
+    if action is None:
+        raise RuntimeError('clip could not be read')
+    frame_start, frame_end = (int(round(f)) for f in action.frame_range)
+    k2_export.export_k2_clip(dst, False, frame_start, frame_end)
+
+def worker_main(argv):
+    parser = argparse.ArgumentParser(prog='k2_batch.py -- --worker')
+    parser.add_argument('--worker', action='store_true')
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args(argv)
+    k2_import, k2_export = load_addon()
+
+    for rel in args.files:
+        src = os.path.join(args.src, rel)
+        dst = os.path.join(args.dst, rel)
+        start = time.perf_counter()
+        try:
+            if rel.lower().endswith('.clip'):
+                convert_clip(k2_import, k2_export, src, dst, args.src)
+            else:
+                convert_model(k2_import, k2_export, src, dst)
+            if not os.path.exists(dst):
+                raise RuntimeError('no output written')
+            status = {'file': rel, 'status': 'done', 'message': ''}
+        except Exception as e:
+            status = {'file': rel, 'status': 'failed', 'message': f'{type(e).__name__}: {e}'}
+        status['seconds'] = round(time.perf_counter() - start, 3)
+        print(STATUS_PREFIX + json.dumps(status), flush=True)
+
+##############################
+# DRIVER (plain Python)
+##############################
+
+def collect_files(src):
+    src = os.path.abspath(src)
+    return [os.path.relpath(path, src) for path in k2_files.find_files(src)]
+
+def load_jobs(path, src, dst):
+    jobs = {'src': os.path.abspath(src), 'dst': os.path.abspath(dst), 'files': {}}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf8') as f:
+            saved = json.load(f)
+        if saved.get('src') == jobs['src'] and saved.get('dst') == jobs['dst']:
+            jobs['files'] = saved.get('files', {})
+    return jobs
+
+def save_jobs(path, jobs):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(jobs, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def run_batch(args, batch):
+    cmd = [args.blender, '-b', '--factory-startup', '--python', os.path.abspath(__file__),
+           '--', '--worker', os.path.abspath(args.src), os.path.abspath(args.dst), *batch]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                              errors='replace', timeout=args.timeout)
+        output = proc.stdout
+        failure = f'Blender exited with code {proc.returncode}'
+    except subprocess.TimeoutExpired as e:
+        output = e.stdout or ''
+        if isinstance(output, bytes):
+            output = output.decode('utf8', 'replace')
+        failure = f'timed out after {args.timeout}s'
+    except OSError as e:
+        output = ''
+        failure = f'could not start Blender: {e}'
+
+    results = {}
+    for line in output.splitlines():
+        if line.startswith(STATUS_PREFIX):
+            status = json.loads(line[len(STATUS_PREFIX):])
+            results[status.pop('file')] = status
+    # Files are converted in order, the first unreported one is where the
+    # worker stopped. Later files were never reached and stay pending.
+    for rel in batch:
+        if rel not in results:
+            results[rel] = {'status': 'failed', 'message': failure, 'seconds': 0.0}
+            break
+    return results
+
+def driver_main(argv):
+    parser = argparse.ArgumentParser(description='Convert a tree of K2 .model/.clip files with background Blender workers.')
+    parser.add_argument('src', help='source directory')
+    parser.add_argument('dst', help='output directory, mirrors the source tree')
+    parser.add_argument('--blender', default='blender', help='Blender executable')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of Blender processes')
+    parser.add_argument('--batch-size', type=int, default=16, help='files converted per Blender process')
+    parser.add_argument('--jobs', help='job list used to resume, default DST/k2_batch_jobs.json')
+    parser.add_argument('--retry-failed', action='store_true', help='convert files that failed in an earlier run again')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a Blender process is killed')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.dst, exist_ok=True)
+    jobs_path = args.jobs or os.path.join(args.dst, 'k2_batch_jobs.json')
+    jobs = load_jobs(jobs_path, args.src, args.dst)
+    for rel in collect_files(args.src):
+        jobs['files'].setdefault(rel, {'status': 'pending', 'message': '', 'seconds': 0.0})
+    todo = [rel for rel, job in sorted(jobs['files'].items())
+            if job['status'] == 'pending' or (args.retry_failed and job['status'] == 'failed')]
+    save_jobs(jobs_path, jobs)
+
+    size = max(1, args.batch_size)
+    batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+    print(f'{len(todo)} file(s) to convert in {len(batches)} batch(es), {len(jobs["files"]) - len(todo)} skipped')
+
+    lock = threading.Lock()
+    finished = 0
+
+    def convert(batch):
+        nonlocal finished
+        results = run_batch(args, batch)
+        with lock:
+            for rel, status in results.items():
+                jobs['files'][rel] = status
+                finished += 1
+                print(f'[{finished}/{len(todo)}] {status["status"]:6} {rel} {status["message"]}'.rstrip(), flush=True)
+            save_jobs(jobs_path, jobs)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        list(pool.map(convert, batches))
+
+    failed = sum(1 for job in jobs['files'].values() if job['status'] == 'failed')
+    pending = sum(1 for job in jobs['files'].values() if job['status'] == 'pending')
+    print(f'done, {failed} failed, {pending} left pending, job list: {jobs_path}')
+    return 1 if failed or pending else 0
+
+if __name__ == '__main__':
+    if '--' in sys.argv and '--worker' in sys.argv[sys.argv.index('--') + 1:]:
+        worker_main(sys.argv[sys.argv.index('--') + 1:])
+    else:
+        sys.exit(driver_main(sys.argv[1:]))
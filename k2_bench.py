@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+# Import/export benchmark over a sweep of synthetic assets.
+#
+#   blender -b --factory-startup --python k2_bench.py -- --sizes 1000,10000,100000 --out bench.json
+#
+# times the parse, scene-build and serialize phases of models and clips
+# separately. Run with a plain Python 3 it only times the parse phase.
+# Results are written as JSON, one record per asset size and phase.
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import k2_synth
+
+def timed(results, phase, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    results.setdefault(phase, []).append(time.perf_counter() - start)
+    return value
+
+def parse_model(k2_decode, path):
+    with k2_decode.ChunkFile(path) as model:
+        return k2_decode.decode_model(model)
+
+def parse_clip(k2_decode, path):
+    with k2_decode.ChunkFile(path) as clip:
+        return k2_decode.decode_clip(clip)
+
+def bench_asset(modules, model_path, clip_path, workdir, repeat):
+    k2_decode, k2_import, k2_export, reset_scene = modules
+    times = {}
+    for _ in range(repeat):
+        model = timed(times, 'model_parse', parse_model, k2_decode, model_path)
+        clip = timed(times, 'clip_parse', parse_clip, k2_decode, clip_path)
+        if k2_import is None:
+            continue
+
+        reset_scene()
+        _, rig = timed(times, 'model_build', k2_import.build_model, model, 'bench')
+        timed(times, 'model_serialize', k2_export.export_k2_mesh, os.path.join(workdir, 'out.model'), False)
+        rig.data.pose_position = 'POSE'
+        timed(times, 'clip_build', k2_import.build_clip, clip, 'bench', rig)
+        timed(times, 'clip_serialize', k2_export.export_k2_clip, os.path.join(workdir, 'out.clip'), False,
+              0, clip.num_frames - 1)
+    return times
+
+def load_modules():
+    if bpy is None:
+        import k2_decode
+        return k2_decode, None, None, None
+    import importlib
+    import k2_batch
+    k2_import, k2_export = k2_batch.load_addon()
+    k2_decode = importlib.import_module(f'{k2_batch.ADDON_MODULE}.k2_decode')
+    return k2_decode, k2_import, k2_export, k2_batch.reset_scene
+
+def environment():
+    import numpy
+    env = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+    if bpy is not None:
+        env['blender'] = bpy.app.version_string
+    return env
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='k2_bench.py', description='Benchmark K2 import/export phases on synthetic assets.')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated total vertex counts')
+    parser.add_argument('--meshes', type=int, default=1)
+    parser.add_argument('--bones', type=int, default=64)
+    parser.add_argument('--influences', type=int, default=4)
+    parser.add_argument('--frames', type=int, default=120)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', help='where assets are written, a temporary directory by default')
+    parser.add_argument('--out', help='JSON results file, printed to stdout when omitted')
+    args = parser.parse_args(argv)
+
+    modules = load_modules()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='k2_bench_')
+    records = []
+    for size in sizes:
+        params = {'verts': size, 'meshes': args.meshes, 'bones': args.bones,
+                  'influences': args.influences, 'frames': args.frames}
+        model_path = k2_synth.write_model(os.path.join(workdir, f'synth_{size}.model'), size, args.meshes,
+                                          args.bones, args.influences)
+        clip_path = k2_synth.write_clip(os.path.join(workdir, f'synth_{size}.clip'), args.bones, args.frames)
+        params['model_bytes'] = os.path.getsize(model_path)
+        params['clip_bytes'] = os.path.getsize(clip_path)
+
+        for phase, times in bench_asset(modules, model_path, clip_path, workdir, max(1, args.repeat)).items():
+            records.append({**params, 'phase': phase, 'times': times,
+                            'min': min(times), 'median': statistics.median(times)})
+            print(f'{size:>9} verts  {phase:16} min {min(times) * 1000:9.2f} ms  median {statistics.median(times) * 1000:9.2f} ms',
+                  file=sys.stderr, flush=True)
+
+    results = json.dumps({'environment': environment(), 'results': records}, indent=1)
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as f:
+            f.write(results)
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:])
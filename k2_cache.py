@@ -0,0 +1,219 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+try:
+    from . import k2_decode
+except ImportError:
+    import k2_decode
+
+# Persistent cache of decoded .model/.clip data.
+#
+# Every entry is one file: a small JSON description followed by the raw
+# arrays, each aligned to 64 bytes, so a hit maps the file and hands out
+# numpy views without decoding or copying anything. Entries are keyed on the
+# source path, size and modification time (optionally its content hash) and
+# the least recently used ones are evicted once the cache grows past its cap.
+
+CACHE_VERSION = 2
+CACHE_MAGIC = b'K2C1'
+CACHE_SUFFIX = '.k2c'
+ALIGNMENT = 64
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+def default_cache_dir():
+    if os.environ.get('K2_CACHE_DIR'):
+        return os.environ['K2_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'k2_blender')
+
+def write_entry(path, meta, arrays):
+    table = []
+    data_size = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        table.append([name, array.dtype.str, list(array.shape), data_size])
+        data_size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'meta': meta, 'arrays': table}).encode('utf8')
+    data_start = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(CACHE_MAGIC + struct.pack('<I', len(header)) + header)
+        for (_, _, _, offset), array in zip(table, arrays.values()):
+            f.seek(data_start + offset)
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + data_size)
+    os.replace(tmp, path)
+
+def read_entry(path):
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:4] != CACHE_MAGIC:
+        raise ValueError('Not a cache entry')
+    header_size = struct.unpack_from('<I', buf, 4)[0]
+    header = json.loads(bytes(buf[8:8 + header_size]).decode('utf8'))
+    data_start = -(-(8 + header_size) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, dtype, shape, offset in header['arrays']:
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+    return header['meta'], arrays
+
+##############################
+# MODEL/CLIP <-> ENTRY
+##############################
+
+def model_to_entry(data):
+    header, bones, meshes = data
+    arrays = {
+        'bones.parents': bones.parents,
+        'bones.inv_matrices': bones.inv_matrices,
+        'bones.matrices': bones.matrices,
+    }
+    mesh_meta = []
+    for i, mesh in enumerate(meshes):
+        prefix = f'mesh{i}.'
+        meta = {'index': mesh.index, 'name': mesh.name, 'material': mesh.material,
+                'mode': mesh.mode, 'bone_link': mesh.bone_link,
+                'links': [bone for bone, _, _ in mesh.links], 'surf': mesh.surf is not None}
+        arrays[prefix + 'verts'] = mesh.verts
+        arrays[prefix + 'faces'] = mesh.faces
+        for field in ('normals', 'texcoords', 'colors', 'signs'):
+            if getattr(mesh, field) is not None:
+                arrays[prefix + field] = getattr(mesh, field)
+        if mesh.links:
+            arrays[prefix + 'link_counts'] = np.array([len(v) for _, v, _ in mesh.links], dtype=np.int64)
+            arrays[prefix + 'link_verts'] = np.concatenate([v for _, v, _ in mesh.links])
+            arrays[prefix + 'link_weights'] = np.concatenate([w for _, _, w in mesh.links])
+        if mesh.surf is not None:
+            for field, table in zip(('planes', 'points', 'edges', 'tris'), mesh.surf):
+                arrays[prefix + 'surf_' + field] = table
+        mesh_meta.append(meta)
+    meta = {'kind': 'model', 'header': list(header[:5]) + [list(header.bbox)],
+            'bone_names': bones.names, 'meshes': mesh_meta}
+    return meta, arrays
+
+def entry_to_model(meta, arrays):
+    *counts, bbox = meta['header']
+    header = k2_decode.ModelHeader(*counts, tuple(bbox))
+    bones = k2_decode.BoneData(meta['bone_names'], arrays['bones.parents'],
+                               arrays['bones.inv_matrices'], arrays['bones.matrices'])
+    meshes = []
+    for i, mesh in enumerate(meta['meshes']):
+        prefix = f'mesh{i}.'
+        links = []
+        if mesh['links']:
+            splits = np.cumsum(arrays[prefix + 'link_counts'])[:-1]
+            links = list(zip(mesh['links'],
+                             np.split(arrays[prefix + 'link_verts'], splits),
+                             np.split(arrays[prefix + 'link_weights'], splits)))
+        surf = None
+        if mesh['surf']:
+            surf = tuple(arrays[prefix + 'surf_' + field] for field in ('planes', 'points', 'edges', 'tris'))
+        meshes.append(k2_decode.MeshData(
+            mesh['index'], mesh['name'], mesh['material'], mesh['mode'], mesh['bone_link'],
+            arrays[prefix + 'verts'], arrays[prefix + 'faces'],
+            arrays.get(prefix + 'normals'), arrays.get(prefix + 'texcoords'),
+            arrays.get(prefix + 'colors'), arrays.get(prefix + 'signs'),
+            links, surf))
+    return k2_decode.ModelData(header, bones, meshes)
+
+def clip_to_entry(data):
+    meta = {'kind': 'clip', 'version': data.version, 'num_bones': data.num_bones,
+            'num_frames': data.num_frames, 'names': data.names}
+    return meta, {'channels': data.channels}
+
+def entry_to_clip(meta, arrays):
+    return k2_decode.ClipData(meta['version'], meta['num_bones'], meta['num_frames'],
+                              meta['names'], arrays['channels'])
+
+##############################
+# CACHE
+##############################
+
+class DecodeCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, hash_content=False):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+
+    def key(self, filename, kind, **options):
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        ident = [CACHE_VERSION, kind, filename, st.st_size, st.st_mtime_ns, sorted(options.items())]
+        if self.hash_content:
+            with open(filename, 'rb') as f:
+                ident.append(hashlib.sha1(f.read()).hexdigest())
+        return hashlib.sha1(json.dumps(ident).encode('utf8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            entry = read_entry(path)
+            # Mark as recently used for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def store(self, key, meta, arrays):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_entry(self.path(key), meta, arrays)
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(CACHE_SUFFIX):
+                    os.remove(os.path.join(self.directory, filename))
+
+    def load_model(self, key):
+        entry = self.load(key)
+        if entry is None or entry[0].get('kind') != 'model':
+            return None
+        return entry_to_model(*entry)
+
+    def store_model(self, key, data):
+        self.store(key, *model_to_entry(data))
+
+    def load_clip(self, key):
+        entry = self.load(key)
+        if entry is None or entry[0].get('kind') != 'clip':
+            return None
+        return entry_to_clip(*entry)
+
+    def store_clip(self, key, data):
+        self.store(key, *clip_to_entry(data))
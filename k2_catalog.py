@@ -0,0 +1,196 @@
+import argparse
+import os
+import sqlite3
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import k2_decode, k2_files
+except ImportError:
+    import k2_decode
+    import k2_files
+
+# bpy-free catalog of .model/.clip libraries.
+#
+#   python k2_catalog.py scan ROOT --db catalog.sqlite --workers 8
+#   python k2_catalog.py query --db catalog.sqlite "SELECT path, num_bones FROM models WHERE num_bones > 80"
+#
+# Only the head, mesh and surf headers and the block table of a file are
+# read, by a pool of processes. The catalog is a SQLite database and a scan
+# only rereads files whose mtime or size changed; files that are gone are
+# dropped.
+#
+# Tables:
+#   files   one row per file: kind, version, counts, bounding box, clip frames
+#   meshes  one row per mesh or surf: name, material, vertex and face counts
+#   chunks  one row per block: tag, owning mesh, offset and size in bytes
+# The models and clips views select the files of one kind.
+
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    signature TEXT,
+    version INTEGER,
+    num_meshes INTEGER,
+    num_sprites INTEGER,
+    num_surfs INTEGER,
+    num_bones INTEGER,
+    num_frames INTEGER,
+    min_x REAL, min_y REAL, min_z REAL,
+    max_x REAL, max_y REAL, max_z REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS meshes (
+    path TEXT,
+    mesh_index INTEGER,
+    kind TEXT,
+    name TEXT,
+    material TEXT,
+    mode INTEGER,
+    bone_link INTEGER,
+    num_verts INTEGER,
+    num_faces INTEGER
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    path TEXT,
+    seq INTEGER,
+    tag TEXT,
+    mesh INTEGER,
+    offset INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS meshes_path ON meshes (path);
+CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+CREATE VIEW IF NOT EXISTS models AS SELECT * FROM files WHERE kind = 'model';
+CREATE VIEW IF NOT EXISTS clips AS SELECT * FROM files WHERE kind = 'clip';
+'''
+
+FILE_COLUMNS = ('path', 'kind', 'mtime_ns', 'size', 'signature', 'version', 'num_meshes', 'num_sprites',
+                'num_surfs', 'num_bones', 'num_frames', 'min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z', 'error')
+MESH_COLUMNS = ('path', 'mesh_index', 'kind', 'name', 'material', 'mode', 'bone_link', 'num_verts', 'num_faces')
+CHUNK_COLUMNS = ('path', 'seq', 'tag', 'mesh', 'offset', 'size')
+
+##############################
+# SCANNING (worker processes)
+##############################
+
+def scan_file(path):
+    # Returns the files row, the k2_decode.MeshSummary list and the chunks rows of one file
+    st = os.stat(path)
+    row = {'path': path, 'kind': os.path.splitext(path)[1][1:].lower(), 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+    meshes = []
+    chunks = []
+    try:
+        with k2_decode.ChunkFile(path) as model:
+            row['signature'] = model.signature.decode('latin-1')
+            chunks = [{'seq': seq, 'tag': entry.tag.decode('latin-1'), 'mesh': entry.mesh,
+                       'offset': entry.offset, 'size': entry.size} for seq, entry in enumerate(model.chunks)]
+            head = model.chunks[0] if model.chunks and model.chunks[0].tag == b'head' else None
+            if model.signature == b'SMDL' and head is not None:
+                header = k2_decode.decode_head(model.chunk(head))
+                row.update(version=header.version, num_meshes=header.num_meshes, num_sprites=header.num_sprites,
+                           num_surfs=header.num_surfs, num_bones=header.num_bones)
+                row.update(zip(('min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z'), header.bbox))
+                meshes = [k2_decode.summarize_mesh(model, group, header.version)
+                          for group in k2_decode.mesh_entry_groups(model.chunks)]
+            elif model.signature == b'CLIP' and head is not None:
+                row['version'], row['num_bones'], row['num_frames'] = struct.unpack_from('<3i', model.view, head.offset)
+            else:
+                row['error'] = 'unknown file signature'
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        row['error'] = f'{type(e).__name__}: {e}'
+    return row, meshes, chunks
+
+##############################
+# CATALOG
+##############################
+
+def open_catalog(db):
+    conn = sqlite3.connect(db)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        for table in ('files', 'meshes', 'chunks'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        for view in ('models', 'clips'):
+            conn.execute(f'DROP VIEW IF EXISTS {view}')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.executescript(SCHEMA)
+    return conn
+
+def insert_rows(conn, table, columns, rows):
+    conn.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                     [tuple(row.get(column) for column in columns) for row in rows])
+
+def delete_files(conn, paths):
+    for table in ('files', 'meshes', 'chunks'):
+        conn.executemany(f'DELETE FROM {table} WHERE path = ?', [(path,) for path in paths])
+
+def scan(conn, root, workers=None):
+    # Returns the numbers of scanned, unchanged and removed files
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, '')
+    known = {path: (mtime_ns, size) for path, mtime_ns, size in
+             conn.execute('SELECT path, mtime_ns, size FROM files') if path.startswith(prefix)}
+    todo = []
+    present = set()
+    for path in k2_files.find_files(root):
+        present.add(path)
+        st = os.stat(path)
+        if known.get(path) != (st.st_mtime_ns, st.st_size):
+            todo.append(path)
+    removed = [path for path in known if path not in present]
+
+    with conn:
+        delete_files(conn, removed + todo)
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for row, meshes, chunks in pool.map(scan_file, todo, chunksize=16):
+                    insert_rows(conn, 'files', FILE_COLUMNS, [row])
+                    insert_rows(conn, 'meshes', MESH_COLUMNS,
+                                [{'path': row['path'], 'mesh_index': mesh.index, **mesh._asdict()} for mesh in meshes])
+                    insert_rows(conn, 'chunks', CHUNK_COLUMNS, [{'path': row['path'], **chunk} for chunk in chunks])
+    return len(todo), len(present) - len(todo), len(removed)
+
+def query(conn, sql, params=()):
+    cursor = conn.execute(sql, params)
+    columns = [column[0] for column in cursor.description or ()]
+    return columns, cursor.fetchall()
+
+##############################
+# COMMAND LINE
+##############################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='k2_catalog.py', description='Catalog the headers of K2 .model/.clip files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan_parser = commands.add_parser('scan', help='add new and changed files under ROOT to the catalog')
+    scan_parser.add_argument('root')
+    scan_parser.add_argument('--db', default='k2_catalog.sqlite', help='catalog database')
+    scan_parser.add_argument('--workers', type=int, default=None, help='number of scanning processes')
+    query_parser = commands.add_parser('query', help='run an SQL query on the catalog')
+    query_parser.add_argument('sql')
+    query_parser.add_argument('--db', default='k2_catalog.sqlite', help='catalog database')
+    args = parser.parse_args(argv)
+
+    conn = open_catalog(args.db)
+    try:
+        if args.command == 'scan':
+            scanned, unchanged, removed = scan(conn, args.root, args.workers)
+            print(f'{scanned} file(s) scanned, {unchanged} unchanged, {removed} removed')
+        else:
+            columns, rows = query(conn, args.sql)
+            if columns:
+                print('\t'.join(columns))
+            for row in rows:
+                print('\t'.join('' if value is None else str(value) for value in row))
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,411 @@
+import mmap
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from .k2_trace import span
+except ImportError:
+    from k2_trace import span
+
+# bpy-free decoders for SMDL chunk payloads.
+# Every decoder takes the whole chunk payload (bytes, bytearray or memoryview,
+# starting with the mesh index) and returns numpy views over it, so no data is
+# copied and no per-vertex Python objects are created.
+
+FACE_INDEX_TYPES = {1: np.dtype('u1'), 2: np.dtype('<u2'), 4: np.dtype('<u4')}
+
+# One entry per block of a .model/.clip file. offset points past the 8-byte
+# block header, mesh is the index of the mesh/surf the block belongs to, -1
+# for blocks outside of any mesh.
+ChunkEntry = namedtuple('ChunkEntry', 'tag offset size mesh')
+
+def index_chunks(buf, start=4):
+    entries = []
+    mesh = -1
+    offset = start
+    end = len(buf)
+    while offset + 8 <= end:
+        tag = bytes(buf[offset:offset + 4])
+        size = struct.unpack_from('<i', buf, offset + 4)[0]
+        offset += 8
+        size = max(0, min(size, end - offset))
+        if tag in (b'mesh', b'surf') and size >= 4:
+            mesh = struct.unpack_from('<i', buf, offset)[0]
+        elif tag in (b'head', b'bone'):
+            mesh = -1
+        entries.append(ChunkEntry(tag, offset, size, mesh))
+        offset += size
+    return entries
+
+class ChunkView:
+    # Read cursor over one block, a drop-in for the parts of chunk.Chunk we use.
+    # view is a memoryview slice of the mapped file and is what the decoders take.
+    def __init__(self, buf, entry):
+        self.entry = entry
+        self.chunksize = entry.size
+        self.view = buf[entry.offset:entry.offset + entry.size]
+        self.pos = 0
+
+    def getname(self):
+        return self.entry.tag
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.chunksize - self.pos
+        data = bytes(self.view[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = min(max(pos, 0), self.chunksize)
+
+    def skip(self):
+        self.pos = self.chunksize
+
+class ChunkFile:
+    # Maps a .model/.clip file once and indexes its blocks, so any block can
+    # be accessed at random without reading the ones before it.
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            if os.fstat(file.fileno()).st_size > 0:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = None
+        self.view = memoryview(self.map if self.map is not None else b'')
+        self.signature = bytes(self.view[:4])
+        self.chunks = index_chunks(self.view)
+
+    def chunk(self, entry):
+        return ChunkView(self.view, entry)
+
+    def find(self, tag, mesh=None):
+        for entry in self.chunks:
+            if entry.tag == tag and (mesh is None or entry.mesh == mesh):
+                return entry
+        return None
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Decoded arrays still view the mapping, it is unmapped once they are freed
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def frombuffer_rows(payload, dtype, offset, width):
+    dtype = np.dtype(dtype)
+    count = (len(payload) - offset) // (dtype.itemsize * width)
+    return np.frombuffer(payload, dtype=dtype, count=count * width, offset=offset).reshape(count, width)
+
+def decode_vertices(payload):
+    return frombuffer_rows(payload, '<f4', 4, 3)
+
+def decode_normals(payload):
+    return frombuffer_rows(payload, '<f4', 4, 3)
+
+def decode_texc(payload, version):
+    # version 3 stores an extra int after the mesh index
+    return frombuffer_rows(payload, '<f4', 8 if version == 3 else 4, 2)
+
+def decode_colr(payload):
+    return frombuffer_rows(payload, 'u1', 4, 4)
+
+def decode_sign(payload):
+    return np.frombuffer(payload, dtype='i1', offset=8)
+
+def decode_faces(payload, version):
+    numfaces = struct.unpack_from('<i', payload, 4)[0]
+    if version == 3:
+        size = payload[8]
+        offset = 9
+    else:
+        size = 4
+        offset = 8
+    if size not in FACE_INDEX_TYPES:
+        raise ValueError(f"Unknown size for faces: {size}")
+    return np.frombuffer(payload, dtype=FACE_INDEX_TYPES[size], count=numfaces * 3, offset=offset).reshape(numfaces, 3)
+
+def decode_links(payload):
+    # Returns flat (vertex, weight, bone index) arrays, one entry per influence
+    numverts = struct.unpack_from('<i', payload, 4)[0]
+    words = np.frombuffer(payload, dtype='<u4', count=len(payload) // 4)
+    # Files usually give every vertex the same number of influences, the
+    # records then form a (vertices, 1 + 2 * width) table
+    if numverts > 0 and len(words) > 2:
+        width = int(words[2])
+        stride = 1 + 2 * width
+        if 2 + numverts * stride <= len(words):
+            records = words[2:2 + numverts * stride].reshape(numverts, stride)
+            if np.all(records[:, 0] == width):
+                verts = np.repeat(np.arange(numverts, dtype=np.int32), width)
+                return verts, records[:, 1:1 + width].ravel().view('<f4'), records[:, 1 + width:].ravel()
+
+    read_count = struct.Struct('<i').unpack_from
+    counts = []
+    starts = []
+    offset = 8
+    for _ in range(numverts):
+        num_weights = read_count(payload, offset)[0]
+        counts.append(num_weights)
+        starts.append(offset + 4)
+        offset += 4 + 8 * num_weights
+
+    counts = np.array(counts, dtype=np.int64)
+    starts = np.array(starts, dtype=np.int64) // 4
+    first = np.cumsum(counts) - counts
+    slot = np.arange(counts.sum()) - np.repeat(first, counts)
+    weight_pos = np.repeat(starts, counts) + slot
+    index_pos = weight_pos + np.repeat(counts, counts)
+    verts = np.repeat(np.arange(numverts, dtype=np.int32), counts)
+    return verts, words[weight_pos].view('<f4'), words[index_pos]
+
+def group_links(verts, weights, indexes):
+    # Splits influences per bone, bones in order of first appearance.
+    # Returns (bone index, vertices, weights) tuples.
+    bones, first, inverse = np.unique(indexes, return_index=True, return_inverse=True)
+    vert_groups = split_groups(inverse, len(bones), verts)
+    weight_groups = split_groups(inverse, len(bones), weights)
+    return [(int(bones[i]), vert_groups[i], weight_groups[i]) for i in np.argsort(first)]
+
+def split_groups(inverse, num_groups, values):
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=num_groups))[:-1]
+    return np.split(values[order], splits)
+
+def decode_surf_header(payload):
+    # surf index, then the plane, point, edge and triangle counts
+    return struct.unpack_from('<5i', payload, 0)
+
+def decode_surf(payload):
+    surfindex, num_planes, num_points, num_edges, num_tris = decode_surf_header(payload)
+    # BMINf, BMAXf, FLAGSi
+    offset = 20 + 4 * 3 + 4 * 3 + 4
+    planes = np.frombuffer(payload, dtype='<f4', count=num_planes * 4, offset=offset).reshape(-1, 4)
+    offset += num_planes * 16
+    points = np.frombuffer(payload, dtype='<f4', count=num_points * 3, offset=offset).reshape(-1, 3)
+    offset += num_points * 12
+    edges = np.frombuffer(payload, dtype='<f4', count=num_edges * 6, offset=offset).reshape(-1, 6)
+    offset += num_edges * 24
+    tris = np.frombuffer(payload, dtype='<u4', count=num_tris * 3, offset=offset).reshape(-1, 3)
+    return planes, points, edges, tris
+
+##############################
+# WHOLE MODELS
+##############################
+
+ModelHeader = namedtuple('ModelHeader', 'version num_meshes num_sprites num_surfs num_bones bbox')
+# matrices are (bones, 4, 4) arrays laid out as in the file, row vectors with
+# the translation in the last row
+BoneData = namedtuple('BoneData', 'names parents inv_matrices matrices')
+# texcoords holds one UV per face corner, links is a list of
+# (bone index, vertices, weights) and surf the (planes, points, edges, tris)
+# tables of a collision surface, None for render meshes
+MeshData = namedtuple('MeshData', 'index name material mode bone_link verts faces normals texcoords colors signs links surf')
+ModelData = namedtuple('ModelData', 'header bones meshes')
+
+def read_cstring(honchunk):
+    name = b''
+    b = honchunk.read(1)
+    while b not in (b'\0', b''):
+        name += b
+        b = honchunk.read(1)
+    return name
+
+def decode_head(honchunk):
+    values = struct.unpack_from('<5i6f', honchunk.view, 0)
+    return ModelHeader(*values[:5], values[5:])
+
+def decode_bones(honchunk, version, num_bones):
+    names = []
+    parents = np.empty(num_bones, dtype=np.int32)
+    inv_matrices = np.zeros((num_bones, 4, 4), dtype=np.float32)
+    matrices = np.zeros((num_bones, 4, 4), dtype=np.float32)
+    for i in range(num_bones):
+        parents[i] = struct.unpack('<i', honchunk.read(4))[0]
+        if version == 3:
+            inv_matrices[i, :, :3] = np.frombuffer(honchunk.read(48), dtype='<f4').reshape(4, 3)
+            matrices[i, :, :3] = np.frombuffer(honchunk.read(48), dtype='<f4').reshape(4, 3)
+            inv_matrices[i, 3, 3] = matrices[i, 3, 3] = 1.0
+            name_length = honchunk.read(1)[0]
+            name = honchunk.read(name_length)
+            honchunk.read(1)  # zero
+        else:
+            pos = honchunk.tell() - 4
+            name = read_cstring(honchunk)
+            honchunk.seek(pos + 0x24)
+            inv_matrices[i] = np.frombuffer(honchunk.read(64), dtype='<f4').reshape(4, 4)
+            matrices[i] = np.frombuffer(honchunk.read(64), dtype='<f4').reshape(4, 4)
+        names.append(name.decode())
+    return BoneData(names, parents, inv_matrices, matrices)
+
+def decode_mesh_header(honchunk, version):
+    index = struct.unpack('<i', honchunk.read(4))[0]
+    mode = 1
+    bone_link = -1
+    if version == 3:
+        mode, num_verts = struct.unpack('<2i', honchunk.read(8))
+        honchunk.read(24)  # bounding box
+        bone_link, sizename, sizemat = struct.unpack('<iBB', honchunk.read(6))
+        name = honchunk.read(sizename)
+        honchunk.read(1)  # zero
+        material = honchunk.read(sizemat)
+    else:
+        pos = honchunk.tell() - 4
+        name = read_cstring(honchunk)
+        honchunk.seek(pos + 0x24)
+        material = read_cstring(honchunk)
+    return index, name.decode(), material.decode(), mode, bone_link
+
+def decode_mesh(model, entries, version, flipuv):
+    with span('parse.mesh', index=entries[0].mesh):
+        return decode_mesh_blocks(model, entries, version, flipuv)
+
+def decode_mesh_blocks(model, entries, version, flipuv):
+    # entries are a mesh or surf block followed by the blocks belonging to it
+    honchunk = model.chunk(entries[0])
+    if entries[0].tag == b'surf':
+        planes, points, edges, tris = decode_surf(honchunk.view)
+        return MeshData(entries[0].mesh, None, None, 1, -1, points, tris.astype(np.int32),
+                        None, None, None, None, [], (planes, points, edges, tris))
+
+    index, name, material, mode, bone_link = decode_mesh_header(honchunk, version)
+    blocks = {}
+    if mode == 1:
+        for entry in entries[1:]:
+            blocks[entry.tag] = model.chunk(entry).view
+
+    verts = decode_vertices(blocks[b'vrts']) if b'vrts' in blocks else np.empty((0, 3), dtype=np.float32)
+    faces = np.empty((0, 3), dtype=np.int32)
+    if b'face' in blocks:
+        faces = decode_faces(blocks[b'face'], version).astype(np.int32)
+
+    texcoords = None
+    if b'texc' in blocks:
+        texc = decode_texc(blocks[b'texc'], version)
+        if flipuv:
+            texc = np.column_stack((texc[:, 0], 1.0 - texc[:, 1]))
+        # One UV per loop, loops follow the face index order
+        texcoords = np.ascontiguousarray(texc[faces.ravel()], dtype=np.float32)
+
+    links = []
+    for tag in (b'lnk1', b'lnk3'):
+        if tag in blocks:
+            links = group_links(*decode_links(blocks[tag]))
+
+    return MeshData(
+        index, name, material, mode, bone_link,
+        np.ascontiguousarray(verts, dtype=np.float32), faces,
+        decode_normals(blocks[b'nrml']) if b'nrml' in blocks else None,
+        texcoords,
+        decode_colr(blocks[b'colr']) if b'colr' in blocks else None,
+        decode_sign(blocks[b'sign']) if b'sign' in blocks else None,
+        links, None)
+
+# Counts of a mesh or surf read from its headers only, kind is 'mesh' or 'surf'
+MeshSummary = namedtuple('MeshSummary', 'index kind name material mode bone_link num_verts num_faces')
+
+def summarize_mesh(model, entries, version):
+    # Same entries as decode_mesh_blocks, but no vertex data is read
+    honchunk = model.chunk(entries[0])
+    if entries[0].tag == b'surf':
+        index, num_planes, num_points, num_edges, num_tris = decode_surf_header(honchunk.view)
+        return MeshSummary(index, 'surf', None, None, 1, -1, num_points, num_tris)
+    index, name, material, mode, bone_link = decode_mesh_header(honchunk, version)
+    num_verts = num_faces = 0
+    for entry in entries[1:]:
+        if entry.tag == b'vrts':
+            num_verts = max(0, (entry.size - 4) // 12)
+        elif entry.tag == b'face' and entry.size >= 8:
+            num_faces = struct.unpack_from('<i', model.view, entry.offset + 4)[0]
+    return MeshSummary(index, 'mesh', name, material, mode, bone_link, num_verts, num_faces)
+
+def mesh_entry_groups(entries):
+    groups = []
+    for entry in entries:
+        if entry.tag in (b'mesh', b'surf'):
+            groups.append([entry])
+        elif entry.tag not in (b'head', b'bone') and groups:
+            groups[-1].append(entry)
+    return groups
+
+def decode_model(model, flipuv=True, workers=None):
+    # Decodes a whole SMDL file held by a ChunkFile into plain arrays.
+    # Meshes are decoded concurrently, numpy releases the GIL while copying.
+    with span('parse.head'):
+        header = decode_head(model.chunk(model.chunks[0]))
+    bone_entry = model.find(b'bone')
+    if bone_entry is None and header.num_bones > 0:
+        raise ValueError('Error reading bone chunk')
+    if bone_entry is not None:
+        with span('parse.bones', bones=header.num_bones):
+            bones = decode_bones(model.chunk(bone_entry), header.version, header.num_bones)
+    else:
+        bones = BoneData([], np.empty(0, dtype=np.int32), np.empty((0, 4, 4), dtype=np.float32), np.empty((0, 4, 4), dtype=np.float32))
+
+    groups = mesh_entry_groups(model.chunks)
+    if len(groups) > 1 and workers != 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            meshes = list(pool.map(lambda group: decode_mesh(model, group, header.version, flipuv), groups))
+    else:
+        meshes = [decode_mesh(model, group, header.version, flipuv) for group in groups]
+    return ModelData(header, bones, meshes)
+
+##############################
+# CLIPS
+##############################
+
+MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z = range(10)
+MKEY_COUNT = 10
+
+# Value of a channel without keys
+MKEY_DEFAULTS = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 255.0, 1.0, 1.0, 1.0)
+
+# channels is a (bones, MKEY_COUNT, num_frames) float32 array, row i holding
+# the channels of bone names[i]. Channels with fewer keys than frames, such
+# as constant single key channels, repeat their last key.
+ClipData = namedtuple('ClipData', 'version num_bones num_frames names channels')
+
+def decode_clip(clip):
+    version, num_bones, num_frames = struct.unpack_from('<3i', clip.chunk(clip.chunks[0]).view, 0)
+    names = {}
+    motions = []
+    for entry in clip.chunks[1:]:
+        clipchunk = clip.chunk(entry)
+        if version == 1:
+            name = clipchunk.read(32).split(b'\0', 1)[0]
+        boneindex, keytype, numkeys = struct.unpack('<3i', clipchunk.read(12))
+        if version > 1:
+            namelength = clipchunk.read(1)[0]
+            name = clipchunk.read(namelength)
+            clipchunk.read(1)
+        if keytype == MKEY_VISIBILITY:
+            keys = np.frombuffer(clipchunk.view, dtype='u1', count=numkeys, offset=clipchunk.tell())
+        else:
+            keys = np.frombuffer(clipchunk.view, dtype='<f4', count=numkeys, offset=clipchunk.tell())
+        row = names.setdefault(name.decode('utf8'), len(names))
+        if 0 <= keytype < MKEY_COUNT and numkeys > 0:
+            motions.append((row, keytype, keys))
+
+    channels = np.empty((len(names), MKEY_COUNT, max(num_frames, 0)), dtype=np.float32)
+    channels[:] = np.array(MKEY_DEFAULTS, dtype=np.float32)[:, None]
+    for row, keytype, keys in motions:
+        count = min(len(keys), num_frames)
+        channels[row, keytype, :count] = keys[:count]
+        channels[row, keytype, count:] = keys[count - 1]
+    if version == 1:
+        # Uniform scale
+        channels[:, MKEY_SCALE_Y:] = channels[:, MKEY_SCALE_X, None]
+    return ClipData(version, num_bones, num_frames, list(names), channels)
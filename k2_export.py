@@ -1,10 +1,17 @@
 import bpy
 import bmesh
+from contextlib import contextmanager
 from io import BytesIO
 import struct
 import os
+import numpy as np
 from math import degrees
-from mathutils import Matrix
+from mathutils import Matrix, Vector, Quaternion, Euler
+from .k2_decode import FACE_INDEX_TYPES
+from . import k2_optimize
+from . import k2_skeleton
+from . import k2_skin
+from . import k2_surf
 
 # Determines the verbosity of logging.
 IMPORT_LOG_LEVEL = 0
@@ -27,29 +34,24 @@ def dlog(msg):
 def err(msg):
     log(msg)
 
-def bone_depth(bone):
-    if not bone.parent:
-        return 0
-    else:
-        return 1 + bone_depth(bone.parent)
-
-def generate_bbox(meshes):
-    xx = []
-    yy = []
-    zz = []
-    for mesh in meshes:
-        nv = [v.co for v in mesh.verts]
-        xx += [co[0] for co in nv]
-        yy += [co[1] for co in nv]
-        zz += [co[2] for co in nv]
-    return [min(xx), min(yy), min(zz), max(xx), max(yy), max(zz)]
-
-def create_mesh_data(mesh, vert, index, name, mname):
+def info(report, msg):
+    log(msg)
+    if report is not None:
+        report({'INFO'}, msg)
+
+def generate_bbox(coords):
+    coords = [co for co in coords if len(co)]
+    if not coords:
+        return [0.0] * 6
+    co = np.concatenate(coords)
+    return [*co.min(axis=0), *co.max(axis=0)]
+
+def create_mesh_data(co, index, name, mname):
     meshdata = BytesIO()
     meshdata.write(struct.pack("<i", index))
     meshdata.write(struct.pack("<i", 1)) # mode? huh? dunno...
-    meshdata.write(struct.pack("<i", len(vert))) # vertices count
-    meshdata.write(struct.pack("<6f", *generate_bbox([mesh]))) # bounding box
+    meshdata.write(struct.pack("<i", len(co))) # vertices count
+    meshdata.write(struct.pack("<6f", *generate_bbox([co]))) # bounding box
     meshdata.write(struct.pack("<i", -1)) # bone link... dunno... TODO
     meshdata.write(struct.pack("<B", len(name))) 
     meshdata.write(struct.pack("<B", len(mname))) 
@@ -59,171 +61,118 @@ def create_mesh_data(mesh, vert, index, name, mname):
     meshdata.write(struct.pack("<B", 0)) 
     return meshdata.getvalue()
 
-def create_vrts_data(verts, meshindex):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    for v in verts:
-        data.write(struct.pack("<3f", *v.co))
-    return data.getvalue()
-
-def create_face_data(verts, faces, meshindex):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    data.write(struct.pack("<i", len(faces)))
-    if len(verts) < 255:
-        data.write(struct.pack("<B", 1))
-        fmt = '<3B'
+# Block payloads are bytes or tuples of bytes and arrays, written in order
+# by write_block without joining them first
+
+def create_vrts_data(co, meshindex):
+    return struct.pack("<i", meshindex), co.astype('<f4')
+
+def create_face_data(nverts, faces, meshindex):
+    if nverts < 255:
+        size = 1
+    elif nverts < 65536:
+        size = 2
     else:
-        data.write(struct.pack("<B", 2))
-        fmt = '<3H'
-    for f in faces:
-        if len(f) == 3:
-            data.write(struct.pack(fmt, *f))
-        else:
-            print(f"Warning: Face {f} is not a triangle and will be skipped")
-    return data.getvalue()
+        size = 4
+    header = struct.pack("<iiB", meshindex, len(faces), size)
+    return header, faces.astype(FACE_INDEX_TYPES[size])
 
 def create_tang_data(tang, meshindex):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    data.write(struct.pack("<i", 0)) # huh?
-    for t in tang:
-        data.write(struct.pack('<3f', *list(t)))
-    return data.getvalue()
+    return struct.pack("<ii", meshindex, 0), tang.astype('<f4') # huh?
 
 def write_block(file, name, data):
+    # The size is reserved and patched once the payload is streamed out
     file.write(name.encode('utf8')[:4])
-    file.write(struct.pack("<i", len(data)))
-    file.write(data)
+    size_pos = file.tell()
+    file.write(b'\0\0\0\0')
+    for part in (data if isinstance(data, tuple) else (data,)):
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part).reshape(-1).view(np.uint8)
+        file.write(part)
+    end = file.tell()
+    file.seek(size_pos)
+    file.write(struct.pack("<i", end - size_pos - 4))
+    file.seek(end)
+
+@contextmanager
+def atomic_output(filename):
+    # Writes go to a temporary file next to the target, which replaces the
+    # target only once everything was written
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as file:
+            yield file
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 def create_texc_data(texc, meshindex):
-    for i in range(len(texc)):
-        texc[i] = [texc[i][0], 1.0 - texc[i][1]]
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    data.write(struct.pack("<i", 0)) # huh?
-    for t in texc:
-        data.write(struct.pack("<2f", *t))
-    return data.getvalue()
+    texc = np.column_stack((texc[:, 0], 1.0 - texc[:, 1]))
+    return struct.pack("<ii", meshindex, 0), texc.astype('<f4') # huh?
 
 def create_colr_data(colr, meshindex):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    for c in colr:
-        data.write(struct.pack("<4B", c.r, c.g, c.b, c.a))
-    return data.getvalue()
-
-def create_nrml_data(verts, meshindex):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    for v in verts:
-        data.write(struct.pack("<3f", *v.normal))
-    return data.getvalue()
-
-def create_lnk1_data(lnk1, meshindex, bone_indices):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    data.write(struct.pack("<i", len(lnk1)))
-    for influences in lnk1:
-        influences = [inf for inf in influences if inf[0] in bone_indices]
-        l = len(influences)
-        data.write(struct.pack("<i", l))
-        if l > 0:
-            data.write(struct.pack('<%df' % l, *[inf[1] for inf in influences]))
-            data.write(struct.pack('<%dI' % l, *[bone_indices[inf[0]] for inf in influences]))
-    return data.getvalue()
+    return struct.pack("<i", meshindex), colr.astype(np.uint8)
 
-def create_sign_data(meshindex, sign):
-    data = BytesIO()
-    data.write(struct.pack("<i", meshindex))
-    data.write(struct.pack("<i", 0))
-    for s in sign:
-        data.write(struct.pack("<b", s))
-    return data.getvalue()
-
-def calcFaceSigns(ftexc):
-    fsigns = []
-    for uv in ftexc:
-        if ((uv[1][0] - uv[0][0]) * (uv[2][1] - uv[1][1]) - (uv[1][1] - uv[0][1]) * (uv[2][0] - uv[1][0])) > 0:
-            fsigns.append((0, 0, 0))
-        else:
-            fsigns.append((-1, -1, -1))
-    return fsigns
-
-def face_to_vertices(faces, fdata, verts):
-    vdata = [None] * len(verts)
-    for fi, f in enumerate(faces):
-        if fi >= len(fdata):
-            print(f"Error: fi ({fi}) out of range for fdata (length {len(fdata)})")
-            continue
-        
-        face_data = fdata[fi]
-        if len(f) != len(face_data):
-            print(f"Error: Mismatch in length of faces[{fi}] ({len(f)}) and fdata[{fi}] ({len(face_data)})")
-            continue
-        
-        for vi, v in enumerate(f):
-            try:
-                vdata[v] = face_data[vi]
-            except IndexError as e:
-                print(f"Error: {e} | fi: {fi}, vi: {vi}, v: {v}, len(fdata): {len(fdata)}, len(fdata[{fi}]): {len(face_data)}")
-                raise e
-    return vdata
-
-def face_to_vertices_dup(faces, fdata, verts):
-    vdata = [None] * len(verts)
-    for fi, f in enumerate(faces):
-        if fi >= len(fdata):
-            print(f"Error: fi ({fi}) out of range for fdata (length {len(fdata)})")
-            continue
-        
-        face_data = fdata[fi]
-        if len(f) != len(face_data):
-            print(f"Error: Mismatch in length of faces[{fi}] ({len(f)}) and fdata[{fi}] ({len(face_data)})")
-            continue
-        
-        for vi, v in enumerate(f):
-            try:
-                if vdata[v] is None or vdata[v] == face_data[vi]:
-                    vdata[v] = face_data[vi]
-                else:
-                    newind = len(verts)
-                    verts.append(verts[v])
-                    faces[fi][vi] = newind
-                    vdata.append(face_data[vi])
-            except IndexError as e:
-                print(f"Error: {e} | fi: {fi}, vi: {vi}, v: {v}, len(fdata): {len(fdata)}, len(fdata[{fi}]): {len(face_data)}")
-                raise e
-    return vdata
+def create_nrml_data(normals, meshindex):
+    return struct.pack("<i", meshindex), normals.astype('<f4')
 
+def create_lnk1_data(skin, meshindex):
+    return k2_skin.lnk1_payload(skin, meshindex)
 
+def create_sign_data(meshindex, sign):
+    return struct.pack("<ii", meshindex, 0), sign.astype(np.int8)
+
+def weld_corners(columns):
+    # columns are per-loop arrays. Loops with identical rows in every column
+    # share one output vertex, vertices are numbered in order of first use.
+    # Returns the first loop of every vertex and the vertex of every loop.
+    num_loops = len(columns[0])
+    if num_loops == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    key = np.hstack([np.ascontiguousarray(c.reshape(num_loops, -1) + 0).view(np.uint8).reshape(num_loops, -1) for c in columns])
+    pad = -key.shape[1] % 8
+    if pad:
+        key = np.hstack((key, np.zeros((num_loops, pad), dtype=np.uint8)))
+
+    # FNV-1a over 64-bit words, rows with equal hashes are checked for collisions
+    words = key.view('<u8')
+    hashes = np.full(num_loops, 0xcbf29ce484222325, dtype=np.uint64)
+    for i in range(words.shape[1]):
+        hashes = (hashes ^ words[:, i]) * np.uint64(0x100000001b3)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    if np.any(key != key[first][inverse]):
+        rows = key.view(np.dtype((np.void, key.shape[1]))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+    return first[order], remap[inverse]
 
 def create_bone_data(armature, armMatrix, transform):
-    bones = []
-    for bone in sorted(armature.bones.values(), key=bone_depth):
-        bones.append(bone.name)
+    skeleton = k2_skeleton.skeleton_table(armature)
+    base = skeleton.rest
+    baseInv = skeleton.inv_rest
+    if transform:
+        base = base @ np.array(armMatrix)
+        baseInv = np.linalg.inv(base)
+    # The file stores the transposed matrices without their last column
+    base = base[:, :3].transpose(0, 2, 1).astype('<f4')
+    baseInv = baseInv[:, :3].transpose(0, 2, 1).astype('<f4')
     bonedata = BytesIO()
-    for name in bones:
-        bone = armature.bones[name]
-        base = bone.matrix_local.copy()
-        if transform:
-            base = base @ armMatrix
-        baseInv = base.copy()
-        baseInv.invert()
-        if bone.parent:
-            parent_index = bones.index(bone.parent.name)
-        else:
-            parent_index = -1
-        baseInv.transpose()
-        base.transpose()
+    for name, parent_index, matrix, inv_matrix in zip(skeleton.names, skeleton.parents, base, baseInv):
         bonedata.write(struct.pack("<i", parent_index))
-        bonedata.write(struct.pack('<12f', *sum([list(row[0:3]) for row in baseInv], [])))
-        bonedata.write(struct.pack('<12f', *sum([list(row[0:3]) for row in base], [])))
+        bonedata.write(inv_matrix.tobytes())
+        bonedata.write(matrix.tobytes())
         name = name.encode('utf8')
         bonedata.write(struct.pack("B", len(name)))
         bonedata.write(name)
         bonedata.write(struct.pack("B", 0))
-    return bones, bonedata.getvalue()
+    return skeleton.index, bonedata.getvalue()
 
 def select_armature_and_mesh():
     # Ensure the operator is called in the correct context
@@ -265,122 +214,313 @@ def select_armature():
     if not armatures_found:
         print("No armature objects found in the scene.")
 
-def export_k2_mesh(filename, applyMods):
+def foreach_array(collection, attr, dtype, width=1):
+    data = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, data)
+    return data.reshape(-1, width) if width > 1 else data
+
+def triangulated_mesh(obj, me):
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    bmesh.ops.triangulate(bm, faces=bm.faces[:])  # Ensure all faces are triangulated
+    bm.transform(obj.matrix_world)
+    # Deform weights are read from the BMesh, everything else in bulk from
+    # the triangulated mesh written back below
+    dvert_lay = bm.verts.layers.deform.active
+    if dvert_lay:
+        lnk1 = k2_skin.gather_influences([vert[dvert_lay].items() for vert in bm.verts])
+    else:
+        lnk1 = None
+    tri = bpy.data.meshes.new(obj.name)
+    bm.to_mesh(tri)
+    bm.free()
+    return tri, lnk1
+
+def read_corner_normals(mesh):
+    if hasattr(mesh, 'corner_normals'):
+        return foreach_array(mesh.corner_normals, 'vector', np.float32, 3)
+    mesh.calc_normals_split()
+    return foreach_array(mesh.loops, 'normal', np.float32, 3)
+
+def read_corner_tangents(mesh, uv_layer):
+    # MikkTSpace tangents of every loop and their sign, -1 where the UV
+    # mapping is mirrored, 0 otherwise
+    if len(mesh.polygons) == 0:
+        return np.empty((0, 3), dtype=np.float32), np.empty(0, dtype=np.int8)
+    mesh.calc_tangents(uvmap=uv_layer.name)
+    ftang = foreach_array(mesh.loops, 'tangent', np.float32, 3)
+    fsign = np.where(foreach_array(mesh.loops, 'bitangent_sign', np.float32) < 0, -1, 0).astype(np.int8)
+    mesh.free_tangents()
+    return ftang, fsign
+
+def read_loop_colors(mesh, loop_verts):
+    color_attr = mesh.color_attributes.active_color
+    if color_attr is None:
+        return None
+    colr = foreach_array(color_attr.data, 'color_srgb', np.float32, 4)
+    if color_attr.domain == 'POINT':
+        colr = colr[loop_verts]
+    return np.clip(np.rint(colr * 255.0), 0, 255).astype(np.uint8)
+
+def evaluated_mesh(obj, applyMods):
+    if not applyMods:
+        return triangulated_mesh(obj, obj.data)
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    obj_eval = obj.evaluated_get(depsgraph)
+    result = triangulated_mesh(obj, obj_eval.to_mesh())
+    obj_eval.to_mesh_clear()
+    return result
+
+def decimated_mesh(obj, applyMods, ratio):
+    # Quadric edge collapse through a temporary Decimate modifier. Blender
+    # interpolates deform weights while collapsing and keeps UV island borders.
+    hidden = []
+    if not applyMods:
+        for mod in obj.modifiers:
+            if mod.show_viewport:
+                mod.show_viewport = False
+                hidden.append(mod)
+    decimate = obj.modifiers.new(name='K2 LOD', type='DECIMATE')
+    decimate.decimate_type = 'COLLAPSE'
+    decimate.ratio = ratio
+    decimate.use_collapse_triangulate = True
+    try:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        obj_eval = obj.evaluated_get(depsgraph)
+        result = triangulated_mesh(obj, obj_eval.to_mesh())
+        obj_eval.to_mesh_clear()
+    finally:
+        obj.modifiers.remove(decimate)
+        for mod in hidden:
+            mod.show_viewport = True
+    return result
+
+def surf_hull(obj, applyMods):
+    # Convex hull of the world space vertices of a collision object
+    if applyMods:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        obj_eval = obj.evaluated_get(depsgraph)
+        me = obj_eval.to_mesh()
+    else:
+        me = obj.data
+    bm = bmesh.new()
+    bm.from_mesh(me)
+    if applyMods:
+        obj_eval.to_mesh_clear()
+    bm.transform(obj.matrix_world)
+    bmesh.ops.delete(bm, geom=bm.edges[:], context='EDGES_FACES')
+    bmesh.ops.convex_hull(bm, input=bm.verts[:])
+    hull = bpy.data.meshes.new(f'{obj.name}_hull')
+    bm.to_mesh(hull)
+    bm.free()
+    hull.calc_loop_triangles()
+    points = foreach_array(hull.vertices, 'co', np.float32, 3)
+    tris = foreach_array(hull.loop_triangles, 'vertices', np.int32, 3)
+    bpy.data.meshes.remove(hull)
+    return k2_surf.surf_tables(points, tris)
+
+def export_k2_mesh(filename, applyMods, optimize_cache=False, lod_ratios=(), report=None,
+                   max_influences=k2_skin.MAX_INFLUENCES, weight_threshold=k2_skin.WEIGHT_THRESHOLD):
     select_armature_and_mesh()
 
-    meshes = []
+    objects = []
+    surf_objects = []
     armature = None
+    bone_indices = bonedata = None
     for obj in bpy.context.selected_objects:
         if obj.type == 'MESH':
-            matrix = obj.matrix_world
-            if applyMods:
-                depsgraph = bpy.context.evaluated_depsgraph_get()
-                me = obj.evaluated_get(depsgraph).to_mesh()
+            # Objects with a true k2_surf custom property are collision hulls
+            if obj.get('k2_surf'):
+                surf_objects.append(obj)
             else:
-                me = obj.data
-            bm = bmesh.new()
-            bm.from_mesh(me)
-            bmesh.ops.triangulate(bm, faces=bm.faces[:])  # Ensure all faces are triangulated
-            me = bm
-            me.transform(matrix)
-            meshes.append((obj, me))
+                objects.append(obj)
         elif obj.type == 'ARMATURE':
             armature = obj.data
             armMatrix = obj.matrix_world
     if armature:
         armature.pose_position = 'REST'
         bone_indices, bonedata = create_bone_data(armature, armMatrix, applyMods)
-    headdata = BytesIO()
-    headdata.write(struct.pack("<i", 3))
-    headdata.write(struct.pack("<i", len(meshes)))
-    headdata.write(struct.pack("<i", 0))
-    headdata.write(struct.pack("<i", 0))
-    if armature:
-        headdata.write(struct.pack("<i", len(armature.bones.values())))
-    else:
-        headdata.write(struct.pack("<i", 0))
-    headdata.write(struct.pack("<6f", *generate_bbox([x for _, x in meshes])))
-    meshindex = 0
+    surfs = []
+    for obj in surf_objects:
+        tables = surf_hull(obj, applyMods)
+        if len(tables.planes) < 4:
+            info(report, '%s: no convex hull, surf skipped' % obj.name)
+            continue
+        info(report, '%s: surf with %d planes, %d edges' % (obj.name, len(tables.planes), len(tables.edges)))
+        surfs.append(tables)
+    skin_limits = (max_influences, weight_threshold)
+    write_k2_model(filename, objects, lambda obj: evaluated_mesh(obj, applyMods),
+                   armature, bone_indices, bonedata, optimize_cache, skin_limits, report, surfs)
+
+    # Extra LOD models share the bone table of the main one
+    base, ext = os.path.splitext(filename)
+    for level, ratio in enumerate(lod_ratios, 1):
+        num_tris = write_k2_model(f'{base}_lod{level}{ext}', objects, lambda obj: decimated_mesh(obj, applyMods, ratio),
+                                  armature, bone_indices, bonedata, optimize_cache, skin_limits, report, surfs)
+        info(report, 'LOD %d (%.2f): %d triangles' % (level, ratio, num_tris))
+
+def write_k2_model(filename, objects, mesh_source, armature, bone_indices, bonedata, optimize_cache, skin_limits, report,
+                   surfs=()):
+    # Objects are evaluated, written and freed one at a time by calling
+    # mesh_source(obj), which returns a temporary triangulated mesh and its
+    # deform weights. surfs are k2_surf.SurfTables written after the meshes.
+    # The head bounding box is patched in at the end.
+    # Returns the number of triangles written.
+    num_bones = len(armature.bones) if armature else 0
+    with atomic_output(filename) as file:
+        file.write(b'SMDL')
+        write_block(file, 'head', struct.pack("<5i6f", 3, len(objects), 0, len(surfs), num_bones, *[0.0] * 6))
+        bbox_pos = file.tell() - 24
+        if armature:
+            write_block(file, 'bone', bonedata)
+
+        corners = []
+        num_tris = 0
+        for meshindex, obj in enumerate(objects):
+            mesh, lnk1 = mesh_source(obj)
+            try:
+                vco, faces = write_k2_mesh(file, meshindex, obj, mesh, lnk1, bone_indices, optimize_cache, skin_limits, report)
+            finally:
+                bpy.data.meshes.remove(mesh)
+            if len(vco):
+                corners.append(np.array(generate_bbox([vco])).reshape(2, 3))
+            num_tris += len(faces)
+
+        for surfindex, tables in enumerate(surfs):
+            write_block(file, 'surf', k2_surf.surf_payload(tables, surfindex))
+
+        file.seek(bbox_pos)
+        file.write(struct.pack("<6f", *generate_bbox(corners)))
+    return num_tris
+
+def write_k2_mesh(file, meshindex, obj, mesh, lnk1, bone_indices, optimize_cache, skin_limits, report):
+    co = foreach_array(mesh.vertices, 'co', np.float32, 3)
+    # Split vertices only where corner attributes differ, weld exact duplicates
+    loop_verts = foreach_array(mesh.loops, 'vertex_index', np.int32)
+    fnrml = read_corner_normals(mesh)
+    columns = [co[loop_verts], fnrml]
+    uv_layer = mesh.uv_layers.active
+    if uv_layer:
+        ftexc = foreach_array(uv_layer.data, 'uv', np.float32, 2)
+        ftang, fsign = read_corner_tangents(mesh, uv_layer)
+        columns += [ftexc, fsign]
+    fcolr = read_loop_colors(mesh, loop_verts)
+    if fcolr is not None:
+        columns.append(fcolr)
+    skin = None
+    if lnk1 is not None:
+        # Vertex group index -> bone index, -1 for groups without a bone
+        group_bones = np.array([bone_indices.get(group.name, -1) if bone_indices else -1
+                                for group in obj.vertex_groups], dtype=np.int64)
+        lnk1_verts, lnk1_groups, lnk1_weights = lnk1
+        skin, clamped = k2_skin.limit_influences(len(co), lnk1_verts, group_bones[lnk1_groups], lnk1_weights, *skin_limits)
+        if clamped:
+            info(report, '%s: %d vertices clamped to %d influences' % (obj.name, clamped, skin_limits[0]))
+        columns += [skin.bones[loop_verts], skin.weights[loop_verts]]
+    first, inverse = weld_corners(columns)
+    faces = inverse.reshape(-1, 3)
+    nverts = len(first)
+    vlog('%d vertices written for %d mesh vertices' % (nverts, len(co)))
+    if uv_layer:
+        tang = np.stack([np.bincount(inverse, ftang[:, i], minlength=nverts) for i in range(3)], axis=1)
+
+    if optimize_cache and len(faces) > 0:
+        acmr_before = k2_optimize.acmr(faces)
+        faces, order = k2_optimize.optimize_vertex_cache(faces, nverts)
+        first = first[order]
+        if uv_layer:
+            tang = tang[order]
+        info(report, '%s: ACMR %.3f -> %.3f' % (obj.name, acmr_before, k2_optimize.acmr(faces)))
+
+    vco = columns[0][first]
+    normals = fnrml[first]
+    if uv_layer:
+        texc = ftexc[first]
+        sign = fsign[first]
+        tang -= normals * np.einsum('ij,ij->i', tang, normals)[:, None]
+        length = np.linalg.norm(tang, axis=1)
+        tang /= np.where(length > 0, length, 1.0)[:, None]
+        tang[sign == 0] *= -1
+    colr = fcolr[first] if fcolr is not None else None
+    vskin = k2_skin.take(skin, loop_verts[first]) if skin is not None else None
+    write_block(file, 'mesh', create_mesh_data(vco, meshindex, obj.name.encode('utf8'), obj.data.materials[0].name.encode('utf8')))
+    write_block(file, 'vrts', create_vrts_data(vco, meshindex))
+    write_block(file, 'lnk1', create_lnk1_data(vskin, meshindex))
+    if len(faces) > 0:
+        write_block(file, 'face', create_face_data(nverts, faces, meshindex))
+        if uv_layer:
+            write_block(file, "texc", create_texc_data(texc, meshindex))
+            write_block(file, "tang", create_tang_data(tang, meshindex))
+            write_block(file, "sign", create_sign_data(meshindex, sign))
+        write_block(file, "nrml", create_nrml_data(normals, meshindex))
+    if colr is not None:
+        write_block(file, "colr", create_colr_data(colr, meshindex))
+    return vco, faces
+
+def read_fcurves(action, data_path, count):
+    if action is None:
+        return [None] * count
+    return [action.fcurves.find(data_path, index=i) for i in range(count)]
+
+def evaluate_channels(fcurves, default, frame):
+    return [fc.evaluate(frame) if fc is not None else value for fc, value in zip(fcurves, default)]
+
+def action_pose_sampler(armob):
+    # Rebuilds each bone's parent-relative pose matrix from the action's
+    # F-curves alone, without evaluating the rest of the scene.
+    # Constraints and drivers are not taken into account.
+    action = armob.animation_data.action if armob.animation_data else None
+    skeleton = k2_skeleton.skeleton_table(armob.data)
+    channels = []
+    for pbone in armob.pose.bones:
+        rest = Matrix(skeleton.local_rest[skeleton.index[pbone.name]].tolist())
+        path = f'pose.bones["{bpy.utils.escape_identifier(pbone.name)}"]'
+        if pbone.rotation_mode == 'QUATERNION':
+            rotation = read_fcurves(action, path + '.rotation_quaternion', 4), tuple(pbone.rotation_quaternion)
+        elif pbone.rotation_mode == 'AXIS_ANGLE':
+            rotation = read_fcurves(action, path + '.rotation_axis_angle', 4), tuple(pbone.rotation_axis_angle)
+        else:
+            rotation = read_fcurves(action, path + '.rotation_euler', 3), tuple(pbone.rotation_euler)
+        channels.append((
+            pbone.name, rest, pbone.rotation_mode,
+            (read_fcurves(action, path + '.location', 3), tuple(pbone.location)),
+            rotation,
+            (read_fcurves(action, path + '.scale', 3), tuple(pbone.scale)),
+        ))
+
+    def sample(frame):
+        matrices = []
+        for name, rest, rotation_mode, location, rotation, scale in channels:
+            loc = evaluate_channels(*location, frame)
+            rot = evaluate_channels(*rotation, frame)
+            if rotation_mode == 'QUATERNION':
+                rot = Quaternion(rot).normalized().to_matrix()
+            elif rotation_mode == 'AXIS_ANGLE':
+                rot = Matrix.Rotation(rot[0], 3, Vector(rot[1:]))
+            else:
+                rot = Euler(rot, rotation_mode).to_matrix()
+            sca = evaluate_channels(*scale, frame)
+            basis = Matrix.LocRotScale(Vector(loc), rot, Vector(sca))
+            matrices.append((name, rest @ basis))
+        return matrices
+    return sample
+
+def scene_pose_sampler(armob):
+    scene = bpy.context.scene
+    pose = armob.pose
 
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    def sample(frame):
+        scene.frame_set(frame)
+        matrices = []
+        for bone in pose.bones:
+            matrix = bone.matrix
+            if bone.parent:
+                matrix = bone.parent.matrix.inverted() @ matrix
+            matrices.append((bone.name, matrix))
+        return matrices
+    return sample
 
-    file = open(filename, 'wb')
-    file.write(b'SMDL')
-    write_block(file, 'head', headdata.getvalue())
-    if armature:
-        write_block(file, 'bone', bonedata)
-
-    for obj, mesh in meshes:
-        vert = [vert for vert in mesh.verts]
-        faces = []
-        ftexc = []
-        ftang = []
-        fcolr = []
-        flnk1 = []
-        uv_lay = mesh.loops.layers.uv.active
-        if not uv_lay:
-            ftexc = None
-        col_lay = mesh.loops.layers.color.active
-        if not col_lay:
-            fcolr = None
-        dvert_lay = mesh.verts.layers.deform.active
-        if dvert_lay:
-            flnk1 = [vert[dvert_lay].items() for vert in mesh.verts]
-        for f in mesh.faces:
-            uv = []
-            col = []
-            vindex = []
-            tang = []
-            for loop in f.loops:
-                if ftexc is not None:
-                    uv.append(loop[uv_lay].uv)
-                vindex.append(loop.vert.index)
-                if fcolr is not None:
-                    col.append(loop[col_lay].color)
-                tang.append(loop.calc_tangent())
-            if ftexc is not None:
-                ftexc.append(uv)
-            ftang.append(tang)
-            faces.append(vindex)
-            if fcolr:
-                fcolr.append(col)
-        if ftexc:
-            fsign = calcFaceSigns(ftexc)
-            sign = face_to_vertices(faces, fsign, vert)
-            texc = face_to_vertices(faces, ftexc, vert)
-            tang = face_to_vertices(faces, ftang, vert)
-        for i in range(len(vert)):
-            tang[i] = (tang[i] - vert[i].normal * tang[i].dot(vert[i].normal))
-            tang[i].normalize()
-        lnk1 = flnk1
-        if fcolr is not None:
-            colr = face_to_vertices(faces, fcolr, vert)
-        else:
-            colr = None
-        write_block(file, 'mesh', create_mesh_data(mesh, vert, meshindex, obj.name.encode('utf8'), obj.data.materials[0].name.encode('utf8')))
-        write_block(file, 'vrts', create_vrts_data(vert, meshindex))
-        new_indices = {}
-        for group in obj.vertex_groups:
-            new_indices[group.index] = bone_indices.index(group.name)
-        write_block(file, 'lnk1', create_lnk1_data(lnk1, meshindex, new_indices))
-        if len(faces) > 0:
-            write_block(file, 'face', create_face_data(vert, faces, meshindex))
-            if ftexc is not None:
-                write_block(file, "texc", create_texc_data(texc, meshindex))
-                for i in range(len(tang)):
-                    if sign[i] == 0:
-                        tang[i] = -(tang[i].copy())
-                write_block(file, "tang", create_tang_data(tang, meshindex))
-                write_block(file, "sign", create_sign_data(meshindex, sign))
-            write_block(file, "nrml", create_nrml_data(vert, meshindex))
-        if fcolr is not None:
-            write_block(file, "colr", create_colr_data(colr, meshindex))
-
-        meshindex += 1
-        vlog('total vertices duplicated: %d' % (len(vert) - len(mesh.verts)))
-
-def export_k2_clip(filename, transform, frame_start, frame_end):
+def export_k2_clip(filename, transform, frame_start, frame_end, sample_action=False):
     select_armature()
     
     objList = bpy.context.selected_objects
@@ -402,23 +542,20 @@ def export_k2_clip(filename, transform, frame_start, frame_end):
     else:
         worldmat = Matrix([[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
     
-    scene = bpy.context.scene
-    pose = armob.pose
+    if sample_action:
+        sample = action_pose_sampler(armob)
+    else:
+        sample = scene_pose_sampler(armob)
     
     for frame in range(frame_start, frame_end + 1):
-        scene.frame_set(frame)
-        
-        for bone in pose.bones:
-            matrix = bone.matrix
-            if bone.parent:
-                matrix = bone.parent.matrix.inverted() @ matrix
+        for bone_name, matrix in sample(frame):
             if transform:
                 matrix = worldmat @ matrix
             
-            if bone.name not in motions:
-                motions[bone.name] = [[] for _ in range(MKEY_COUNT)]
+            if bone_name not in motions:
+                motions[bone_name] = [[] for _ in range(MKEY_COUNT)]
             
-            motion = motions[bone.name]
+            motion = motions[bone_name]
             translation = matrix.to_translation()
             rotation = matrix.to_euler('YXZ')
             scale = matrix.to_scale()
@@ -434,43 +571,19 @@ def export_k2_clip(filename, transform, frame_start, frame_end):
             motion[MKEY_SCALE_Z].append(scale[2])
             motion[MKEY_VISIBILITY].append(visibility)
     
-    headdata = BytesIO()
-    headdata.write(struct.pack("<i", 2))
-    headdata.write(struct.pack("<i", len(motions.keys())))
-    headdata.write(struct.pack("<i", frame_end - frame_start + 1))
-    
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    
-    file = open(filename, 'wb')
-    file.write(b'CLIP')
-    write_block(file, 'head', headdata.getvalue())
-    
-    index = 0
-    
-    for bone_name in sorted(armature.bones.keys(), key=lambda x: bone_depth(armature.bones[x])):
-        ClipBone(file, bone_name.encode('utf8'), motions[bone_name], index)
-        index += 1
-    
-    file.close()
+    with atomic_output(filename) as file:
+        file.write(b'CLIP')
+        write_block(file, 'head', struct.pack("<3i", 2, len(motions), frame_end - frame_start + 1))
+        for index, bone_name in enumerate(k2_skeleton.skeleton_table(armature).names):
+            ClipBone(file, bone_name.encode('utf8'), motions[bone_name], index)
 
 def ClipBone(file, bone_name, motion, index):
     for keytype in range(MKEY_COUNT):
-        keydata = BytesIO()
         key = motion[keytype]
         if min(key) == max(key):
             key = [key[0]]
-        numkeys = len(key)
-        keydata.write(struct.pack("<i", index))
-        keydata.write(struct.pack("<i", keytype))
-        keydata.write(struct.pack("<i", numkeys))
-        keydata.write(struct.pack("B", len(bone_name)))
-        keydata.write(bone_name)
-        keydata.write(struct.pack("B", 0))
-        if keytype == MKEY_VISIBILITY:
-            keydata.write(struct.pack('%dB' % numkeys, *key))
-        else:
-            keydata.write(struct.pack('<%df' % numkeys, *key))
-        write_block(file, 'bmtn', keydata.getvalue())
+        header = struct.pack("<3iB", index, keytype, len(key), len(bone_name)) + bone_name + b'\0'
+        keys = np.array(key, dtype='u1' if keytype == MKEY_VISIBILITY else '<f4')
+        write_block(file, 'bmtn', (header, keys))
 
 
@@ -0,0 +1,16 @@
+import os
+
+# Directory walking shared by the batch converter and the catalog scanner.
+# Standard library only, so the batch driver runs with any Python 3.
+
+EXTENSIONS = ('.model', '.clip')
+
+def find_files(root, extensions=EXTENSIONS):
+    # Absolute paths of the files under root, in a stable order
+    files = []
+    for directory, dirnames, filenames in os.walk(os.path.abspath(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(extensions):
+                files.append(os.path.join(directory, filename))
+    return files
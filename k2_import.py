@@ -1,134 +1,41 @@
 import bpy
 import bmesh
-import struct
-import chunk
 import itertools
-from mathutils import Vector, Matrix, Euler
+from collections import namedtuple
+from mathutils import Vector, Matrix
 import math
+import numpy as np
 from bpy.props import *
-
-# Log level
-IMPORT_LOG_LEVEL = 3
-
-def log(msg):
-    if IMPORT_LOG_LEVEL >= 1:
-        print(msg)
-
-def vlog(msg):
-    if IMPORT_LOG_LEVEL >= 2:
-        print(msg)
-
-def dlog(msg):
-    if IMPORT_LOG_LEVEL >= 3:
-        print(msg)
-
-def err(msg):
-    log(f"ERROR: {msg}")
-
-def read_int(honchunk):
-    return struct.unpack("<i", honchunk.read(4))[0]
-
-def read_float(honchunk):
-    return struct.unpack("<f", honchunk.read(4))[0]
-
-def parse_links(honchunk, bone_names):
-    mesh_index = read_int(honchunk)
-    numverts = read_int(honchunk)
-    log("Parsing links")
-    vlog(f"Mesh index: {mesh_index}")
-    vlog(f"Number of vertices: {numverts}")
-
-    vgroups = {}
-    for i in range(numverts):
-        num_weights = read_int(honchunk)
-        if num_weights > 0:
-            weights = struct.unpack(f"<{num_weights}f", honchunk.read(num_weights * 4))
-            indexes = struct.unpack(f"<{num_weights}I", honchunk.read(num_weights * 4))
-        else:
-            weights = indexes = []
-
-        for ii, index in enumerate(indexes):
-            name = bone_names[index]
-            if name not in vgroups:
-                vgroups[name] = []
-            vgroups[name].append((i, weights[ii]))
-
-    honchunk.skip()
-    return vgroups
-
-def parse_vertices(honchunk):
-    vlog('Parsing vertices chunk')
-    numverts = int((honchunk.chunksize - 4) / 12)
-    vlog(f'{numverts} vertices')
-    meshindex = read_int(honchunk)
-    return [struct.unpack("<3f", honchunk.read(12)) for _ in range(numverts)]
-
-def parse_sign(honchunk):
-    vlog('Parsing sign chunk')
-    numverts = honchunk.chunksize - 8
-    meshindex = read_int(honchunk)
-    vlog(read_int(honchunk))  # huh?
-    return [struct.unpack("<b", honchunk.read(1)) for _ in range(numverts)]
-
-def parse_faces(honchunk, version):
-    vlog('Parsing faces chunk')
-    meshindex = read_int(honchunk)
-    numfaces = read_int(honchunk)
-    vlog(f'{numfaces} faces')
-
-    if version == 3:
-        size = struct.unpack('B', honchunk.read(1))[0]
-    elif version == 1:
-        size = 4
-
-    if size == 2:
-        return [struct.unpack("<3H", honchunk.read(6)) for _ in range(numfaces)]
-    elif size == 1:
-        return [struct.unpack("<3B", honchunk.read(3)) for _ in range(numfaces)]
-    elif size == 4:
-        return [struct.unpack("<3I", honchunk.read(12)) for _ in range(numfaces)]
-    else:
-        log(f"Unknown size for faces: {size}")
-        return []
-
-def parse_normals(honchunk):
-    vlog('Parsing normals chunk')
-    numverts = int((honchunk.chunksize - 4) / 12)
-    vlog(f'{numverts} normals')
-    meshindex = read_int(honchunk)
-    return [struct.unpack("<3f", honchunk.read(12)) for _ in range(numverts)]
-
-def parse_texc(honchunk, version):
-    vlog('Parsing UV texc chunk')
-    numverts = int((honchunk.chunksize - 4) / 8)
-    vlog(f'{numverts} texc')
-    meshindex = read_int(honchunk)
-    if version == 3:
-        vlog(read_int(honchunk))  # huh?
-    return [struct.unpack("<2f", honchunk.read(8)) for _ in range(numverts)]
-
-def parse_colr(honchunk):
-    vlog('Parsing vertex colors chunk')
-    numverts = int((honchunk.chunksize - 4) / 4)
-    meshindex = read_int(honchunk)
-    return [struct.unpack("<4B", honchunk.read(4)) for _ in range(numverts)]
-
-def parse_surf(honchunk):
-    vlog('Parsing surface chunk')
-    surfindex = read_int(honchunk)
-    num_planes = read_int(honchunk)
-    num_points = read_int(honchunk)
-    num_edges = read_int(honchunk)
-    num_tris = read_int(honchunk)
-
-    # BMINf, BMAXf, FLAGSi
-    honchunk.read(4 * 3 + 4 * 3 + 4)
-    return (
-        [struct.unpack("<4f", honchunk.read(4 * 4)) for _ in range(num_planes)],
-        [struct.unpack("<3f", honchunk.read(4 * 3)) for _ in range(num_points)],
-        [struct.unpack("<6f", honchunk.read(4 * 6)) for _ in range(num_edges)],
-        [struct.unpack("<3I", honchunk.read(4 * 3)) for _ in range(num_tris)]
-    )
+from . import k2_decode
+from . import k2_keys
+from . import k2_skeleton
+from .k2_trace import log, vlog, dlog, err, span
+
+def write_vertex_weights(msh, groups):
+    # groups holds (vertices, weights) per vertex group, in group index order.
+    # All weights are written in one pass through a BMesh deform layer. The
+    # last influence of a vertex in a group wins, as with REPLACE adds.
+    if not groups:
+        return
+    verts = np.concatenate([verts for verts, _ in groups])
+    weights = np.concatenate([weights for _, weights in groups])
+    group_index = np.repeat(np.arange(len(groups)), [len(verts) for verts, _ in groups])
+    # By vertex, so each deform vertex is looked up once
+    order = np.argsort(verts, kind='stable')
+
+    bm = bmesh.new()
+    bm.from_mesh(msh)
+    deform = bm.verts.layers.deform.verify()
+    bm.verts.ensure_lookup_table()
+    bm_verts = bm.verts
+    previous = -1
+    for vert, group, weight in zip(verts[order].tolist(), group_index[order].tolist(), weights[order].tolist()):
+        if vert != previous:
+            dvert = bm_verts[vert][deform]
+            previous = vert
+        dvert[group] = weight
+    bm.to_mesh(msh)
+    bm.free()
 
 def round_vector(vec, dec=17):
     return Vector([round(v, dec) for v in vec])
@@ -158,280 +65,166 @@ def mat3_to_vec_roll(mat):
     roll = math.atan2(rollmat[0][2], rollmat[2][2])
     return vec, roll
 
-def create_blender_mesh(filename, objname, flipuv):
+def fill_mesh(msh, verts, faces):
+    verts = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1, 3)
+    num_loops = faces.size
+    msh.vertices.add(len(verts))
+    msh.vertices.foreach_set('co', verts.ravel())
+    msh.loops.add(num_loops)
+    msh.loops.foreach_set('vertex_index', faces.ravel())
+    msh.polygons.add(len(faces))
+    # loop_total is derived from loop_start since Blender 4.0
+    msh.polygons.foreach_set('loop_start', np.arange(0, num_loops, 3, dtype=np.int32))
+    msh.polygons.foreach_set('use_smooth', np.ones(len(faces), dtype=bool))
+    msh.update(calc_edges=True)
+
+def create_blender_mesh(filename, objname, flipuv, cache=None):
+    obj = rig = None
     try:
-        with open(filename, 'rb') as file:
-            sig = file.read(4)
-            if sig != b'SMDL':
-                err('Unknown file signature')
-                return
-
-            honchunk = chunk.Chunk(file, bigendian=False, align=False)
-            if honchunk.getname() != b'head':
-                log('File does not start with head chunk!')
-                return
-
-            version = read_int(honchunk)
-            num_meshes = read_int(honchunk)
-            num_sprites = read_int(honchunk)
-            num_surfs = read_int(honchunk)
-            num_bones = read_int(honchunk)
-
-            vlog(f"Version {version}")
-            vlog(f"{num_meshes} mesh(es)")
-            vlog(f"{num_sprites} sprite(s)")
-            vlog(f"{num_surfs} surf(s)")
-            vlog(f"{num_bones} bone(s)")
-            vlog("Bounding box: (%f, %f, %f) - (%f, %f, %f)" % struct.unpack("<ffffff", honchunk.read(24)))
-            honchunk.skip()
-
-            scn = bpy.context.scene
-
-            try:
-                honchunk = chunk.Chunk(file, bigendian=False, align=False)
-            except EOFError:
-                log('Error reading bone chunk')
-                return
-
-            # Read bones
-            armature_data = bpy.data.armatures.new(f'{objname}_Armature')
-            armature_data.display_type = 'STICK'
-            armature_data.show_names = True
-            rig = bpy.data.objects.new(f'{objname}_Rig', armature_data)
-            scn.collection.objects.link(rig)
-            bpy.context.view_layer.objects.active = rig
-            rig.select_set(True)
-
-            bpy.ops.object.mode_set(mode='EDIT')
-
-            bones = []
-            bone_names = []
-            parents = []
-            for i in range(num_bones):
-                name = ''
-                parent_bone_index = read_int(honchunk)
-
-                if version == 3:
-                    inv_matrix = Matrix([struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                         struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                         struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                         struct.unpack('<3f', honchunk.read(12)) + (1.0,)])
-                    matrix = Matrix([struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                     struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                     struct.unpack('<3f', honchunk.read(12)) + (0.0,),
-                                     struct.unpack('<3f', honchunk.read(12)) + (1.0,)])
-                    name_length = struct.unpack("B", honchunk.read(1))[0]
-                    name = honchunk.read(name_length)
-                    honchunk.read(1)  # zero
-                elif version == 1:
-                    pos = honchunk.tell() - 4
-                    b = honchunk.read(1)
-                    name = ''
-                    while b != b'\0':
-                        name += b.decode()
-                        b = honchunk.read(1)
-                    honchunk.seek(pos + 0x24)
-                    inv_matrix = Matrix([struct.unpack('<4f', honchunk.read(16)),
-                                         struct.unpack('<4f', honchunk.read(16)),
-                                         struct.unpack('<4f', honchunk.read(16)),
-                                         struct.unpack('<4f', honchunk.read(16))])
-                    matrix = Matrix([struct.unpack('<4f', honchunk.read(16)),
-                                     struct.unpack('<4f', honchunk.read(16)),
-                                     struct.unpack('<4f', honchunk.read(16)),
-                                     struct.unpack('<4f', honchunk.read(16))])
-
-                name = name.decode()
-                log(f"Bone name: {name}, parent {parent_bone_index}")
-                bone_names.append(name)
-                matrix.transpose()
-                matrix = round_matrix(matrix, 4)
-                pos = matrix.translation
-                axis, roll = mat3_to_vec_roll(matrix.to_3x3())
-                bone = armature_data.edit_bones.new(name)
-                bone.head = pos
-                bone.tail = pos + axis
-                bone.roll = roll
-                parents.append(parent_bone_index)
-                bones.append(bone)
-
-            for i in range(num_bones):
-                if parents[i] != -1:
-                    bones[i].parent = bones[parents[i]]
-
-            honchunk.skip()
-
-            bpy.ops.object.mode_set(mode='OBJECT')
-            rig.show_in_front = True
-            bpy.context.view_layer.update()
-
-            try:
-                honchunk = chunk.Chunk(file, bigendian=False, align=False)
-            except EOFError:
-                log('Error reading mesh chunk')
-                return
-
-            while honchunk and honchunk.getname() in [b'mesh', b'surf']:
-                verts = []
-                faces = []
-                signs = []
-                nrml = []
-                texc = []
-                colors = []
-                surf_planes = []
-                surf_points = []
-                surf_edges = []
-                surf_tris = []
-
-                if honchunk.getname() == b'mesh':
-                    surf = False
-                    vlog(f"Mesh index: {read_int(honchunk)}")
-                    mode = 1
-                    if version == 3:
-                        mode = read_int(honchunk)
-                        vlog(f"Mode: {mode}")
-                        vlog(f"Vertices count: {read_int(honchunk)}")
-                        vlog("Bounding box: (%f, %f, %f) - (%f, %f, %f)" % struct.unpack("<ffffff", honchunk.read(24)))
-                        bone_link = read_int(honchunk)
-                        vlog(f"Bone link: {bone_link}")
-                        sizename = struct.unpack('B', honchunk.read(1))[0]
-                        sizemat = struct.unpack('B', honchunk.read(1))[0]
-                        meshname = honchunk.read(sizename)
-                        honchunk.read(1)  # zero
-                        materialname = honchunk.read(sizemat)
-                    elif version == 1:
-                        bone_link = -1
-                        pos = honchunk.tell() - 4
-                        b = honchunk.read(1)
-                        meshname = ''
-                        while b != b'\0':
-                            meshname += b.decode()
-                            b = honchunk.read(1)
-                        honchunk.seek(pos + 0x24)
-                        b = honchunk.read(1)
-                        materialname = ''
-                        while b != b'\0':
-                            materialname += b.decode()
-                            b = honchunk.read(1)
-
-                    honchunk.skip()
-
-                    meshname = meshname.decode()
-                    materialname = materialname.decode()
-                    while True:
-                        try:
-                            honchunk = chunk.Chunk(file, bigendian=False, align=False)
-                        except EOFError:
-                            vlog('Done reading chunks')
-                            honchunk = None
-                            break
-                        if honchunk.getname() in [b'mesh', b'surf']:
-                            break
-                        elif mode != 1:
-                            honchunk.skip()
-                        else:
-                            if honchunk.getname() == b'vrts':
-                                verts = parse_vertices(honchunk)
-                            elif honchunk.getname() == b'face':
-                                faces = parse_faces(honchunk, version)
-                            elif honchunk.getname() == b'nrml':
-                                nrml = parse_normals(honchunk)
-                            elif honchunk.getname() == b'texc':
-                                texc = parse_texc(honchunk, version)
-                            elif honchunk.getname() == b'colr':
-                                colors = parse_colr(honchunk)
-                            elif honchunk.getname() in [b'lnk1', b'lnk3']:
-                                vgroups = parse_links(honchunk, bone_names)
-                            elif honchunk.getname() == b'sign':
-                                signs = parse_sign(honchunk)
-                            elif honchunk.getname == b'tang':
-                                honchunk.skip()
-                            else:
-                                vlog(f'Unknown chunk: {honchunk.getname()}')
-                                honchunk.skip()
-                elif honchunk.getname() == b'surf':
-                    surf_planes, surf_points, surf_edges, surf_tris = parse_surf(honchunk)
-                    print(surf_planes)
-                    print(surf_points)
-                    print(surf_edges)
-                    print(surf_tris)
-                    verts = surf_points
-                    faces = surf_tris
-                    surf = True
-                    meshname = f'{objname}_surf'
-                    honchunk.skip()
-                    mode = 1
-                    try:
-                        honchunk = chunk.Chunk(file, bigendian=False, align=False)
-                    except EOFError:
-                        vlog('Done reading chunks')
-                        honchunk = None
-
-                if mode != 1:
-                    continue
-
-                msh = bpy.data.meshes.new(name=meshname)
-                msh.from_pydata(verts, [], faces)
-                msh.update()
-
-                if materialname is not None:
-                    msh.materials.append(bpy.data.materials.new(materialname))
-
-                if len(texc) > 0:
-                    if flipuv:
-                        texc = [(uv[0], 1 - uv[1]) for uv in texc]
-
-                    # Generate texCoords for faces
-                    texcoords = [texc[vert_id] for face in faces for vert_id in face]
-
-                    # Create a UV map
-                    uv_layer = msh.uv_layers.new(name=f'UVMain{meshname}')
-                    for face in msh.polygons:
-                        for vert_idx, loop_idx in zip(face.vertices, face.loop_indices):
-                            uv_layer.data[loop_idx].uv = texc[vert_idx]
-
-                obj = bpy.data.objects.new(f'{meshname}_Object', msh)
-                # Link object to scene
-                scn.collection.objects.link(obj)
-                bpy.context.view_layer.objects.active = obj
-                bpy.context.view_layer.update()
-
-                if surf or mode != 1:
-                    obj.display_type = 'WIRE'
-                else:
-                    # Vertex groups
-                    if bone_link >= 0:
-                        grp = obj.vertex_groups.new(name=bone_names[bone_link])
-                        grp.add(list(range(len(msh.vertices))), 1.0, 'REPLACE')
-                    for name, vg in vgroups.items():
-                        grp = obj.vertex_groups.new(name=name)
-                        for v, w in vg:
-                            grp.add([v], w, 'REPLACE')
-
-                    mod = obj.modifiers.new(name='MyRigModif', type='ARMATURE')
-                    mod.object = rig
-                    mod.use_bone_envelopes = False
-                    mod.use_vertex_groups = True
-
-                    bpy.context.view_layer.objects.active = rig
-                    rig.select_set(True)
-                    bpy.ops.object.mode_set(mode='POSE')
-                    pose = rig.pose
-                    for b in pose.bones:
-                        b.rotation_mode = 'QUATERNION'
-                    bpy.ops.object.mode_set(mode='OBJECT')
-                    rig.select_set(False)
-                bpy.context.view_layer.objects.active = None
-
-            bpy.context.view_layer.update()
-
-            view_all_in_3d_view()
+        # Decode everything first, then build the datablocks from the arrays
+        data = load_model_data(filename, flipuv, cache)
+        if data is None:
+            return
+
+        obj, rig = build_model(data, objname)
+        view_all_in_3d_view()
 
     except IOError as e:
-        log(f"File IO Error: {e}")
+        log("File IO Error: %s", e)
     except Exception as e:
-        log(f"Unexpected error: {e}")
+        log("Unexpected error: %s", e)
     return obj, rig  # Assuming you want to return the created objects
 
+def run_steps(steps):
+    # Runs a build generator to the end and returns its result
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+def build_model(data, objname):
+    return run_steps(build_model_steps(data, objname))
+
+def build_model_steps(data, objname):
+    # Builds the armature, then one mesh object per step.
+    # Yields (phase, done, total) after every step, returns (obj, rig).
+    header = data.header
+    vlog("Version %d", header.version)
+    vlog("%d mesh(es)", header.num_meshes)
+    vlog("%d sprite(s)", header.num_sprites)
+    vlog("%d surf(s)", header.num_surfs)
+    vlog("%d bone(s)", header.num_bones)
+    vlog("Bounding box: (%f, %f, %f) - (%f, %f, %f)", *header.bbox)
+
+    obj = None
+    with span('build.armature', bones=len(data.bones.names)):
+        rig = build_armature(data.bones, objname)
+    if not data.meshes:
+        log('Error reading mesh chunk')
+        return obj, rig
+    meshes = [mesh for mesh in data.meshes if mesh.mode == 1]
+    yield 'Armature', 1, 1
+    for i, mesh in enumerate(meshes):
+        with span('build.mesh', mesh=mesh.name, verts=len(mesh.verts)):
+            obj = build_mesh_object(mesh, objname, rig, data.bones.names)
+        yield 'Meshes', i + 1, len(meshes)
+
+    bpy.context.view_layer.update()
+    return obj, rig
+
+def build_armature(bones, objname):
+    scn = bpy.context.scene
+    armature_data = bpy.data.armatures.new(f'{objname}_Armature')
+    armature_data.display_type = 'STICK'
+    armature_data.show_names = True
+    rig = bpy.data.objects.new(f'{objname}_Rig', armature_data)
+    scn.collection.objects.link(rig)
+    bpy.context.view_layer.objects.active = rig
+    rig.select_set(True)
+
+    bpy.ops.object.mode_set(mode='EDIT')
+
+    edit_bones = []
+    for name, parent_bone_index, matrix in zip(bones.names, bones.parents, bones.matrices):
+        dlog("Bone name: %s, parent %d", name, parent_bone_index)
+        matrix = Matrix(matrix.tolist())
+        matrix.transpose()
+        matrix = round_matrix(matrix, 4)
+        pos = matrix.translation
+        axis, roll = mat3_to_vec_roll(matrix.to_3x3())
+        bone = armature_data.edit_bones.new(name)
+        bone.head = pos
+        bone.tail = pos + axis
+        bone.roll = roll
+        edit_bones.append(bone)
+
+    for bone, parent_bone_index in zip(edit_bones, bones.parents):
+        if parent_bone_index != -1:
+            bone.parent = edit_bones[parent_bone_index]
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+    rig.show_in_front = True
+    bpy.context.view_layer.update()
+    for b in rig.pose.bones:
+        b.rotation_mode = 'QUATERNION'
+    rig.select_set(False)
+    return rig
+
+def build_mesh_object(mesh, objname, rig, bone_names):
+    scn = bpy.context.scene
+    if mesh.surf is not None:
+        vlog("Surf: %d planes, %d points, %d edges, %d triangles", *map(len, mesh.surf))
+        meshname = f'{objname}_surf'
+    else:
+        meshname = mesh.name
+        vlog("Mesh index: %d", mesh.index)
+        vlog("%d vertices, %d faces", len(mesh.verts), len(mesh.faces))
+
+    msh = bpy.data.meshes.new(name=meshname)
+    fill_mesh(msh, mesh.verts, mesh.faces)
+    if mesh.normals is not None and len(mesh.normals) == len(mesh.verts):
+        # Shade with the nrml vertex normals, as the engine does
+        if hasattr(msh, 'use_auto_smooth'):
+            msh.use_auto_smooth = True
+        msh.normals_split_custom_set_from_vertices(mesh.normals)
+
+    if mesh.material is not None:
+        msh.materials.append(bpy.data.materials.new(mesh.material))
+
+    if mesh.texcoords is not None:
+        # Create a UV map
+        uv_layer = msh.uv_layers.new(name=f'UVMain{meshname}')
+        uv_layer.data.foreach_set('uv', mesh.texcoords.ravel())
+
+    obj = bpy.data.objects.new(f'{meshname}_Object', msh)
+    # Link object to scene
+    scn.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+
+    if mesh.surf is not None:
+        obj.display_type = 'WIRE'
+        # Exported again as a collision hull
+        obj['k2_surf'] = True
+    else:
+        # Vertex groups
+        with span('build.weights', mesh=meshname, groups=len(mesh.links)):
+            groups = []
+            if mesh.bone_link >= 0:
+                obj.vertex_groups.new(name=bone_names[mesh.bone_link])
+                groups.append((np.arange(len(msh.vertices)), np.ones(len(msh.vertices), dtype=np.float32)))
+            for bone_index, vg_verts, vg_weights in mesh.links:
+                obj.vertex_groups.new(name=bone_names[bone_index])
+                groups.append((vg_verts, vg_weights))
+            write_vertex_weights(msh, groups)
+
+        mod = obj.modifiers.new(name='MyRigModif', type='ARMATURE')
+        mod.object = rig
+        mod.use_bone_envelopes = False
+        mod.use_vertex_groups = True
+    bpy.context.view_layer.objects.active = None
+    return obj
+
 def view_all_in_3d_view():
     for window in bpy.context.window_manager.windows:
         screen = window.screen
@@ -456,135 +249,200 @@ def view_all_in_3d_view():
 # CLIPS
 ##############################
 
-MKEY_X, MKEY_Y, MKEY_Z, MKEY_PITCH, MKEY_ROLL, MKEY_YAW, MKEY_VISIBILITY, MKEY_SCALE_X, MKEY_SCALE_Y, MKEY_SCALE_Z = range(10)
-
-def bone_depth(bone):
-    if not bone.parent:
-        return 0
-    else:
-        return 1 + bone_depth(bone.parent)
-
-def get_transform_matrix(motions, bone, i, version):
-    motion = motions[bone.name]
-    # Translation
-    x = motion[MKEY_X][i] if i < len(motion[MKEY_X]) else motion[MKEY_X][-1]
-    y = motion[MKEY_Y][i] if i < len(motion[MKEY_Y]) else motion[MKEY_Y][-1]
-    z = motion[MKEY_Z][i] if i < len(motion[MKEY_Z]) else motion[MKEY_Z][-1]
-
-    # Rotation
-    rx = motion[MKEY_PITCH][i] if i < len(motion[MKEY_PITCH]) else motion[MKEY_PITCH][-1]
-    ry = motion[MKEY_ROLL][i] if i < len(motion[MKEY_ROLL]) else motion[MKEY_ROLL][-1]
-    rz = motion[MKEY_YAW][i] if i < len(motion[MKEY_YAW]) else motion[MKEY_YAW][-1]
-
-    # Scaling
-    if version == 1:
-        sx = motion[MKEY_SCALE_X][i] if i < len(motion[MKEY_SCALE_X]) else motion[MKEY_SCALE_X][-1]
-        sy = sz = sx
+def write_bone_fcurves(action, bone_name, prop, values, tolerance=None):
+    # values holds a row of components per frame. With a tolerance the keys
+    # are reduced, using linear interpolation the reduction is measured for.
+    # Returns the number of keys written.
+    if tolerance is None:
+        frames = np.arange(len(values))
+        keys = [(frames, column) for column in np.asarray(values).T]
+        # Same interpolation keyframe_insert would have used
+        interpolation = bpy.context.preferences.edit.keyframe_new_interpolation_type
     else:
-        sx = motion[MKEY_SCALE_X][i] if i < len(motion[MKEY_SCALE_X]) else motion[MKEY_SCALE_X][-1]
-        sy = motion[MKEY_SCALE_Y][i] if i < len(motion[MKEY_SCALE_Y]) else motion[MKEY_SCALE_Y][-1]
-        sz = motion[MKEY_SCALE_Z][i] if i < len(motion[MKEY_SCALE_Z]) else motion[MKEY_SCALE_Z][-1]
-
-    scale = Vector([sx, sy, sz])
-    bone_rotation_matrix = Euler((math.radians(rx), math.radians(ry), math.radians(rz)), 'YXZ').to_matrix().to_4x4()
-    bone_rotation_matrix = Matrix.Translation(Vector((x, y, z))) @ bone_rotation_matrix
-
-    return bone_rotation_matrix, scale
-
-def animate_bone(name, pose, motions, num_frames, armature, arm_ob, version):
-    if name not in armature.bones.keys():
-        log(f'{name} not found in armature')
-        return
-
-    motion = motions[name]
-    bone = armature.bones[name]
-    bone_rest_matrix = Matrix(bone.matrix_local)
-
-    if bone.parent is not None:
-        parent_bone = bone.parent
-        parent_rest_bone_matrix = Matrix(parent_bone.matrix_local)
-        parent_rest_bone_matrix.invert()
-        bone_rest_matrix = parent_rest_bone_matrix @ bone_rest_matrix
-
-    bone_rest_matrix_inv = Matrix(bone_rest_matrix).inverted()
+        keys = k2_keys.reduce_keys(values, tolerance)
+        interpolation = 'LINEAR'
+    interpolation = bpy.types.Keyframe.bl_rna.properties['interpolation'].enum_items[interpolation].value
+    data_path = f'pose.bones["{bpy.utils.escape_identifier(bone_name)}"].{prop}'
+    num_written = 0
+    for index, (frames, column) in enumerate(keys):
+        num_keys = len(frames)
+        co = np.empty((num_keys, 2), dtype=np.float32)
+        co[:, 0] = frames
+        co[:, 1] = column
+        fcurve = action.fcurves.new(data_path, index=index, action_group=bone_name)
+        fcurve.keyframe_points.add(num_keys)
+        fcurve.keyframe_points.foreach_set('co', co.ravel())
+        fcurve.keyframe_points.foreach_set('interpolation', np.full(num_keys, interpolation, dtype=np.int32))
+        fcurve.update()
+        num_written += num_keys
+    return num_written
+
+def load_model_data(filename, flipuv, cache=None):
+    if cache is not None:
+        key = cache.key(filename, 'model', flipuv=flipuv)
+        with span('parse.cache'):
+            data = cache.load_model(key)
+        if data is not None:
+            vlog("Decoded model loaded from cache %s", key)
+            return data
+
+    with k2_decode.ChunkFile(filename) as model:
+        if model.signature != b'SMDL':
+            err('Unknown file signature')
+            return None
+
+        if not model.chunks or model.chunks[0].tag != b'head':
+            log('File does not start with head chunk!')
+            return None
+
+        try:
+            with span('parse.model'):
+                data = k2_decode.decode_model(model, flipuv)
+        except ValueError as e:
+            log(str(e))
+            return None
+
+    if cache is not None:
+        cache.store_model(key, data)
+    return data
+
+def load_clip_data(filename, cache=None):
+    if cache is not None:
+        key = cache.key(filename, 'clip')
+        with span('parse.cache'):
+            data = cache.load_clip(key)
+        if data is not None:
+            vlog("Decoded clip loaded from cache %s", key)
+            return data
+
+    with k2_decode.ChunkFile(filename) as clip:
+        if clip.signature != b'CLIP' or not clip.chunks:
+            err('Unknown file signature')
+            return None
+        with span('parse.clip'):
+            data = k2_decode.decode_clip(clip)
+
+    if cache is not None:
+        cache.store_clip(key, data)
+    return data
+
+def create_blender_clip(filename, clipname, cache=None):
+    try:
+        clip = load_clip_data(filename, cache)
+        if clip is None:
+            return
 
-    pbone = pose.bones[name]
-    for i in range(num_frames):
-        transform, size = get_transform_matrix(motions, bone, i, version)
-        transform = bone_rest_matrix_inv @ transform
-        pbone.rotation_quaternion = transform.to_quaternion()
-        pbone.location = transform.to_translation()
-        pbone.keyframe_insert(data_path='rotation_quaternion', frame=i)
-        pbone.keyframe_insert(data_path='location', frame=i)
+        if not bpy.context.selected_objects:
+            err('No object selected')
+            return
 
-def create_blender_clip(filename, clipname):
-    try:
-        with open(filename, 'rb') as file:
-            sig = file.read(4)
-            if sig != b'CLIP':
-                err('Unknown file signature')
-                return
-
-            clipchunk = chunk.Chunk(file, bigendian=False, align=False)
-            version = read_int(clipchunk)
-            num_bones = read_int(clipchunk)
-            num_frames = read_int(clipchunk)
-            vlog(f"Version: {version}")
-            vlog(f"Number of bones: {num_bones}")
-            vlog(f"Number of frames: {num_frames}")
-
-            if not bpy.context.selected_objects:
-                err('No object selected')
-                return
-
-            arm_ob = bpy.context.selected_objects[0]
-            if not arm_ob.animation_data:
-                arm_ob.animation_data_create()
-            armature = arm_ob.data
-            action = bpy.data.actions.new(name=clipname)
-            arm_ob.animation_data.action = action
-            pose = arm_ob.pose
-
-            motions = {}
-
-            while True:
-                try:
-                    clipchunk = chunk.Chunk(file, bigendian=False, align=False)
-                except EOFError:
-                    break
-
-                if version == 1:
-                    name = clipchunk.read(32).split(b'\0', 1)[0]
-                boneindex = read_int(clipchunk)
-                keytype = read_int(clipchunk)
-                numkeys = read_int(clipchunk)
-                if version > 1:
-                    namelength = struct.unpack("B", clipchunk.read(1))[0]
-                    name = clipchunk.read(namelength)
-                    clipchunk.read(1)
-                name = name.decode("utf8")
-
-                if name not in motions:
-                    motions[name] = {}
-                dlog(f"{name}, bone index: {boneindex}, key type: {keytype}, number of keys: {numkeys}")
-                if keytype == MKEY_VISIBILITY:
-                    data = struct.unpack(f"{numkeys}B", clipchunk.read(numkeys))
-                else:
-                    data = struct.unpack(f"<{numkeys}f", clipchunk.read(numkeys * 4))
-                motions[name][keytype] = list(data)
-                clipchunk.skip()
-
-            # File read, now animate
-            for bone_name in motions:
-                animate_bone(bone_name, pose, motions, num_frames, armature, arm_ob, version)
+        build_clip(clip, clipname, bpy.context.selected_objects[0])
 
     except IOError as e:
-        log(f"File IO Error: {e}")
-
-def readclip(filepath):
+        log("File IO Error: %s", e)
+
+def build_clip(clip, clipname, arm_ob):
+    return run_steps(build_clip_steps(clip, clipname, arm_ob))
+
+# Keys written for an imported clip, against one key per frame on every F-Curve
+ImportedClip = namedtuple('ImportedClip', 'name action keys samples')
+
+def build_clip_steps(clip, clipname, arm_ob, skeleton=None, phase='Keyframes', tolerances=None):
+    # Keys one bone per step. Yields (phase, done, total), returns the action.
+    # tolerances is an optional (location, rotation angle) pair for key
+    # reduction.
+    vlog("Version: %d", clip.version)
+    vlog("Number of bones: %d", clip.num_bones)
+    vlog("Number of frames: %d", clip.num_frames)
+
+    if not arm_ob.animation_data:
+        arm_ob.animation_data_create()
+    action = bpy.data.actions.new(name=clipname)
+    arm_ob.animation_data.action = action
+
+    # Rest matrices are shared by all bones and clips of this armature
+    if skeleton is None:
+        skeleton = k2_skeleton.skeleton_table(arm_ob.data)
+
+    for name in clip.names:
+        if name not in skeleton.index:
+            log('%s not found in armature', name)
+
+    # Poses of all bones and frames at once, keyframes are then written bone by bone
+    with span('build.pose', bones=len(clip.names), frames=clip.num_frames):
+        names, rotations, locations = k2_skeleton.clip_pose(clip, skeleton)
+    location_tolerance = rotation_tolerance = None
+    if tolerances is not None:
+        location_tolerance = tolerances[0]
+        rotation_tolerance = k2_keys.quaternion_tolerance(tolerances[1])
+    for i, bone_name in enumerate(names):
+        with span('build.keyframes', bone=bone_name, frames=clip.num_frames):
+            write_bone_fcurves(action, bone_name, 'rotation_quaternion', rotations[i], rotation_tolerance)
+            write_bone_fcurves(action, bone_name, 'location', locations[i], location_tolerance)
+        yield phase, i + 1, len(names)
+    return action
+
+def build_clips_steps(clips, arm_ob, use_nla=False, fake_user=False, tolerances=None):
+    # clips are (name, ClipData) pairs, each becomes its own action. With
+    # use_nla the actions are laid out back to back as strips of one NLA track.
+    # Returns an ImportedClip per clip.
+    skeleton = k2_skeleton.skeleton_table(arm_ob.data)
+    imported = []
+    for i, (clipname, clip) in enumerate(clips):
+        action = yield from build_clip_steps(clip, clipname, arm_ob, skeleton, f'Clip {i + 1}/{len(clips)}', tolerances)
+        action.use_fake_user = fake_user
+        keys = sum(len(fcurve.keyframe_points) for fcurve in action.fcurves)
+        imported.append(ImportedClip(clipname, action, keys, clip.num_frames * len(action.fcurves)))
+        vlog("%s: %d of %d keys", clipname, imported[-1].keys, imported[-1].samples)
+    if use_nla and imported:
+        stack_nla_strips(arm_ob, [clip.action for clip in imported])
+    return imported
+
+def stack_nla_strips(arm_ob, actions, track_name='K2 Clips'):
+    anim = arm_ob.animation_data
+    track = anim.nla_tracks.new()
+    track.name = track_name
+    start = int(bpy.context.scene.frame_start)
+    for action in actions:
+        strip = track.strips.new(action.name, start, action)
+        # Strips of a track may not touch
+        start = int(math.ceil(strip.frame_end)) + 1
+    # Let the NLA drive the pose
+    anim.action = None
+    return track
+
+# Data-blocks an import may create, removed again when it is cancelled.
+# Objects go first so nothing else is still in use when it is removed.
+ROLLBACK_COLLECTIONS = ('objects', 'meshes', 'armatures', 'materials', 'actions')
+
+def snapshot_ids():
+    return {name: {id.as_pointer() for id in getattr(bpy.data, name)} for name in ROLLBACK_COLLECTIONS}
+
+def remove_new_ids(snapshot):
+    if bpy.context.object is not None and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for name in ROLLBACK_COLLECTIONS:
+        collection = getattr(bpy.data, name)
+        for id in [id for id in collection if id.as_pointer() not in snapshot[name]]:
+            collection.remove(id)
+
+def readclips(filepaths, cache=None, use_nla=False, fake_user=False, tolerances=None):
+    if not bpy.context.selected_objects:
+        err('No object selected')
+        return []
+    clips = []
+    for filepath in filepaths:
+        clip = load_clip_data(filepath, cache)
+        if clip is None:
+            log('Skipping %s', filepath)
+            continue
+        clips.append((bpy.path.display_name_from_filepath(filepath), clip))
+    return run_steps(build_clips_steps(clips, bpy.context.selected_objects[0], use_nla, fake_user, tolerances))
+
+def readclip(filepath, cache=None):
     obj_name = bpy.path.display_name_from_filepath(filepath)
-    create_blender_clip(filepath, obj_name)
+    create_blender_clip(filepath, obj_name, cache)
 
-def read(filepath, flipuv):
+def read(filepath, flipuv, cache=None):
     obj_name = bpy.path.display_name_from_filepath(filepath)
-    create_blender_mesh(filepath, obj_name, flipuv)
+    create_blender_mesh(filepath, obj_name, flipuv, cache)
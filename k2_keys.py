@@ -0,0 +1,68 @@
+import math
+import numpy as np
+
+# bpy-free keyframe reduction for clip import.
+#
+# A clip samples every frame. Frames are dropped while linear interpolation
+# between the kept ones stays within a tolerance, measured on the components
+# of a property together (location xyz, rotation quaternion wxyz), so the
+# F-Curves of one property share their keyed frames. Components that do not
+# change by more than the tolerance get a single key.
+
+LOCATION_TOLERANCE = 0.0001
+ROTATION_TOLERANCE = math.radians(0.1)
+
+def quaternion_tolerance(angle):
+    # Distance between unit quaternions that differ by a rotation of angle radians
+    return 2 * math.sin(angle / 4)
+
+def simplify(values, tolerance, reference=None):
+    # values is a (frames, components) array. Returns the sorted indices of
+    # the frames to key (Ramer-Douglas-Peucker on the frame axis). The error
+    # of the interpolated values is measured against reference, values by
+    # default.
+    if reference is None:
+        reference = values
+    num_frames = len(values)
+    if num_frames <= 2:
+        return np.arange(num_frames)
+    keep = np.zeros(num_frames, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, num_frames - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        t = np.arange(1, last - first) / (last - first)
+        line = values[first] + t[:, None] * (values[last] - values[first])
+        error = np.linalg.norm(reference[first + 1:last] - line, axis=1)
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+def reduce_keys(values, tolerance):
+    # Returns a (frames, values) pair of arrays per component
+    values = np.asarray(values, dtype=np.float64)
+    keyed = values.copy()
+    constant = np.zeros(values.shape[1], dtype=bool)
+    if len(values):
+        # Near constant components become their midrange before simplifying,
+        # so the error measured there includes the one of the single key
+        low, high = values.min(axis=0), values.max(axis=0)
+        constant = high - low <= tolerance
+        keyed[:, constant] = (low + high)[constant] / 2
+        if np.linalg.norm(keyed - values, axis=1).max() > tolerance:
+            keyed = values.copy()
+            constant[:] = False
+    frames = simplify(keyed, tolerance, values)
+    keys = []
+    for i, column in enumerate(keyed.T):
+        if constant[i]:
+            keys.append((np.zeros(1, dtype=np.int64), column[:1]))
+        else:
+            keys.append((frames, column[frames]))
+    return keys
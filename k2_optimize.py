@@ -0,0 +1,98 @@
+from collections import deque
+import numpy as np
+
+# bpy-free index buffer optimizations for exported meshes.
+
+VERTEX_CACHE_SIZE = 16
+
+def acmr(faces, cache_size=VERTEX_CACHE_SIZE):
+    # Average cache miss ratio of a FIFO post-transform cache, misses per triangle
+    if len(faces) == 0:
+        return 0.0
+    fifo = deque()
+    cached = set()
+    misses = 0
+    for v in faces.ravel().tolist():
+        if v not in cached:
+            misses += 1
+            fifo.append(v)
+            cached.add(v)
+            if len(fifo) > cache_size:
+                cached.discard(fifo.popleft())
+    return misses / len(faces)
+
+def tipsify(faces, nverts, cache_size=VERTEX_CACHE_SIZE):
+    # Triangle order for vertex cache locality, after Sander, Nehab and
+    # Barczak, "Fast Triangle Reordering for Vertex Locality and Reduced
+    # Overdraw" (2007). Returns the new order as triangle indices.
+    num_tris = len(faces)
+    flat = faces.ravel()
+    counts = np.bincount(flat, minlength=nverts)
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    adjacency = (np.argsort(flat, kind='stable') // 3).tolist()
+    tris = faces.tolist()
+    live = counts.tolist()
+    cache_time = [0] * nverts
+    emitted = bytearray(num_tris)
+    dead_end = []
+    order = []
+    time = cache_size + 1
+    cursor = 0
+    fanning = 0 if num_tris else -1
+
+    while fanning >= 0:
+        candidates = []
+        for t in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = 1
+            order.append(t)
+            for v in tris[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+
+        # Prefer the candidate that stays in cache longest while still having triangles
+        fanning = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = time - cache_time[v]
+                if priority > best:
+                    best = priority
+                    fanning = v
+        if fanning < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+        if fanning < 0:
+            while cursor < nverts:
+                if live[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+
+    return np.array(order, dtype=np.int64)
+
+def first_use_order(faces, nverts):
+    # Renumbers vertices in the order the index buffer first references them.
+    # Returns the new faces and the old index of every new vertex.
+    used, first = np.unique(faces.ravel(), return_index=True)
+    order = used[np.argsort(first)]
+    if len(order) < nverts:
+        unused = np.setdiff1d(np.arange(nverts), used)
+        order = np.concatenate((order, unused))
+    remap = np.empty(nverts, dtype=faces.dtype)
+    remap[order] = np.arange(nverts, dtype=faces.dtype)
+    return remap[faces], order
+
+def optimize_vertex_cache(faces, nverts, cache_size=VERTEX_CACHE_SIZE):
+    faces = faces[tipsify(faces, nverts, cache_size)]
+    return first_use_order(faces, nverts)
@@ -0,0 +1,128 @@
+from collections import namedtuple
+import numpy as np
+
+# Bone table of an armature shared by the importer and exporter.
+#
+# names are in file order: parents before children, bones of equal depth in
+# armature order. All matrices are (bones, 4, 4) float64 arrays in mathutils
+# layout (column vectors, translation in the last column). rest is the
+# armature space rest matrix (Bone.matrix_local), local_rest the rest matrix
+# relative to the parent bone.
+SkeletonTable = namedtuple('SkeletonTable', 'names index parents rest inv_rest local_rest inv_local_rest')
+
+# Tables by armature pointer, reused while names, parents and rest matrices
+# are unchanged
+_tables = {}
+
+def bone_depths(parents):
+    depths = [-1] * len(parents)
+    for i in range(len(parents)):
+        chain = []
+        j = i
+        while j >= 0 and depths[j] < 0:
+            chain.append(j)
+            j = parents[j]
+        depth = depths[j] + 1 if j >= 0 else 0
+        for j in reversed(chain):
+            depths[j] = depth
+            depth += 1
+    return depths
+
+def build_table(names, parents, rest):
+    # names/parents/rest in armature order, parents as indices into names
+    depths = np.array(bone_depths(parents), dtype=np.int64)
+    order = np.argsort(depths, kind='stable')
+    remap = np.empty(len(order), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    parents = np.asarray(parents, dtype=np.int64)[order]
+    parents = np.where(parents >= 0, remap[np.maximum(parents, 0)], -1).astype(np.int32)
+    names = [names[i] for i in order]
+    rest = rest[order]
+
+    inv_rest = np.linalg.inv(rest) if len(rest) else rest.copy()
+    local_rest = rest.copy()
+    has_parent = parents >= 0
+    local_rest[has_parent] = inv_rest[parents[has_parent]] @ rest[has_parent]
+    inv_local_rest = np.linalg.inv(local_rest) if len(rest) else rest.copy()
+    return SkeletonTable(names, {name: i for i, name in enumerate(names)}, parents,
+                         rest, inv_rest, local_rest, inv_local_rest)
+
+def skeleton_table(armature):
+    bones = armature.bones
+    names = bones.keys()
+    # foreach_get flattens matrices column by column
+    flat = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get('matrix_local', flat)
+    parent_names = [bone.parent.name if bone.parent else None for bone in bones]
+
+    key = armature.as_pointer()
+    cached = _tables.get(key)
+    if cached is not None:
+        source, table = cached
+        if source[0] == names and source[1] == parent_names and np.array_equal(source[2], flat):
+            return table
+
+    lookup = {name: i for i, name in enumerate(names)}
+    parents = [lookup[name] if name is not None else -1 for name in parent_names]
+    rest = flat.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+    table = build_table(names, parents, rest)
+    _tables[key] = ((names, parent_names, flat), table)
+    return table
+
+def euler_yxz_matrices(pitch, roll, yaw):
+    # Euler((pitch, roll, yaw), 'YXZ').to_matrix() for arrays of angles in
+    # radians: R = Rz @ Rx @ Ry
+    cx, sx = np.cos(pitch), np.sin(pitch)
+    cy, sy = np.cos(roll), np.sin(roll)
+    cz, sz = np.cos(yaw), np.sin(yaw)
+    m = np.empty(np.shape(pitch) + (3, 3))
+    m[..., 0, 0] = cz * cy - sz * sx * sy
+    m[..., 0, 1] = -sz * cx
+    m[..., 0, 2] = cz * sy + sz * sx * cy
+    m[..., 1, 0] = sz * cy + cz * sx * sy
+    m[..., 1, 1] = cz * cx
+    m[..., 1, 2] = sz * sy - cz * sx * cy
+    m[..., 2, 0] = -cx * sy
+    m[..., 2, 1] = sx
+    m[..., 2, 2] = cx * cy
+    return m
+
+def matrix_to_quaternion(m):
+    # (..., 3, 3) rotation matrices to (..., 4) wxyz quaternions with w >= 0,
+    # as Matrix.to_quaternion(). Each element uses the best conditioned of the
+    # four extraction formulas.
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+    diagonal = np.stack((m00 + m11 + m22, m00, m11, m22))
+    case = np.argmax(diagonal, axis=0)
+
+    s = np.stack((1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22))
+    s = 2 * np.sqrt(np.maximum(np.take_along_axis(s, case[None], axis=0)[0], 1e-12))
+    candidates = np.stack((
+        np.stack((s * s / 4, m21 - m12, m02 - m20, m10 - m01), axis=-1),
+        np.stack((m21 - m12, s * s / 4, m01 + m10, m02 + m20), axis=-1),
+        np.stack((m02 - m20, m01 + m10, s * s / 4, m12 + m21), axis=-1),
+        np.stack((m10 - m01, m02 + m20, m12 + m21, s * s / 4), axis=-1),
+    ))
+    q = np.take_along_axis(candidates, case[None, ..., None], axis=0)[0] / s[..., None]
+    q /= np.linalg.norm(q, axis=-1, keepdims=True)
+    q[q[..., 0] < 0] *= -1
+    return q
+
+def clip_pose(clip, skeleton):
+    # Pose bone rotation_quaternion and location keys of every frame, for the
+    # bones of clip (a k2_decode.ClipData) found in skeleton. Returns the bone
+    # names, (bones, frames, 4) quaternions and (bones, frames, 3) locations.
+    rows = [i for i, name in enumerate(clip.names) if name in skeleton.index]
+    names = [clip.names[i] for i in rows]
+    channels = clip.channels[rows].astype(np.float64)
+
+    transform = np.zeros(channels.shape[:1] + channels.shape[2:] + (4, 4))
+    transform[..., :3, :3] = euler_yxz_matrices(*np.radians(channels[:, 3:6].transpose(1, 0, 2)))
+    transform[..., :3, 3] = channels[:, 0:3].transpose(0, 2, 1)
+    transform[..., 3, 3] = 1.0
+
+    inv_rest = skeleton.inv_local_rest[[skeleton.index[name] for name in names]]
+    transform = inv_rest[:, None] @ transform
+    return names, matrix_to_quaternion(transform[..., :3, :3]), transform[..., :3, 3]
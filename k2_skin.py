@@ -0,0 +1,68 @@
+from collections import namedtuple
+import struct
+import numpy as np
+
+# bpy-free skin weight stage of the mesh exporter.
+#
+# Influences are gathered into flat arrays once, then pruned, capped and
+# normalized in bulk. The result holds one row per vertex, strongest
+# influence first: bones (-1 for unused slots), weights and the number of
+# influences in use.
+
+MAX_INFLUENCES = 4
+WEIGHT_THRESHOLD = 0.01
+
+SkinWeights = namedtuple('SkinWeights', 'bones weights counts')
+
+def gather_influences(items):
+    # items holds the (group index, weight) pairs of every vertex.
+    # Returns flat (vertex, group, weight) arrays, one entry per influence.
+    counts = np.fromiter(map(len, items), dtype=np.int64, count=len(items))
+    pairs = np.array([pair for influences in items for pair in influences], dtype=np.float64).reshape(-1, 2)
+    verts = np.repeat(np.arange(len(items), dtype=np.int64), counts)
+    return verts, pairs[:, 0].astype(np.int64), pairs[:, 1].astype(np.float32)
+
+def limit_influences(num_verts, verts, bones, weights, max_influences=MAX_INFLUENCES, threshold=WEIGHT_THRESHOLD):
+    # bones < 0 are influences of groups without a bone and are dropped.
+    # Weights below threshold are pruned, but the strongest influence of a
+    # vertex is always kept. Returns the SkinWeights and the number of
+    # vertices that had more than max_influences influences left.
+    keep = bones >= 0
+    verts, bones, weights = verts[keep], bones[keep], weights[keep]
+    order = np.lexsort((-weights, verts))
+    verts, bones, weights = verts[order], bones[order], weights[order]
+    counts = np.bincount(verts, minlength=num_verts)
+    rank = np.arange(len(verts)) - (np.cumsum(counts) - counts)[verts]
+
+    keep = (weights >= threshold) | (rank == 0)
+    counts = np.bincount(verts[keep], minlength=num_verts)
+    clamped = int(np.count_nonzero(counts > max_influences))
+    keep &= rank < max_influences
+    counts = np.minimum(counts, max_influences)
+
+    width = int(counts.max()) if num_verts else 0
+    dense_bones = np.full((num_verts, width), -1, dtype=np.int32)
+    dense_weights = np.zeros((num_verts, width), dtype=np.float32)
+    dense_bones[verts[keep], rank[keep]] = bones[keep]
+    dense_weights[verts[keep], rank[keep]] = weights[keep]
+    total = dense_weights.sum(axis=1, keepdims=True)
+    np.divide(dense_weights, total, out=dense_weights, where=total > 0)
+    return SkinWeights(dense_bones, dense_weights, counts), clamped
+
+def take(skin, indices):
+    return SkinWeights(skin.bones[indices], skin.weights[indices], skin.counts[indices])
+
+def lnk1_payload(skin, meshindex):
+    # Every vertex record is: count, count weights, count bone indices
+    # Returns the header and the record words
+    if skin is None:
+        return struct.pack('<ii', meshindex, 0), np.empty(0, dtype='<u4')
+    counts = skin.counts
+    sizes = 1 + 2 * counts
+    starts = np.cumsum(sizes) - sizes
+    words = np.empty(int(sizes.sum()), dtype='<u4')
+    words[starts] = counts
+    rows, slots = np.nonzero(np.arange(skin.bones.shape[1]) < counts[:, None])
+    words[starts[rows] + 1 + slots] = skin.weights[rows, slots].astype('<f4').view('<u4')
+    words[starts[rows] + 1 + counts[rows] + slots] = skin.bones[rows, slots]
+    return struct.pack('<ii', meshindex, len(counts)), words
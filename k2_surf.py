@@ -0,0 +1,64 @@
+from collections import namedtuple
+import struct
+import numpy as np
+
+# bpy-free collision surface (surf block) tables of a convex hull.
+#
+# planes are (nx, ny, nz, d) rows with n.p = d for points p on the plane and
+# n facing out of the hull, edges are (point, unit direction) rows for the
+# hull edges between two different planes, tris index points.
+
+SurfTables = namedtuple('SurfTables', 'planes points edges tris')
+
+def surf_tables(points, tris, decimals=5):
+    # points and tris of a closed convex hull, triangle winding may be mixed
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+    scale = max(float(np.ptp(points, axis=0).max()) if len(points) else 0.0, 1e-6)
+
+    a, b, c = points[tris[:, 0]], points[tris[:, 1]], points[tris[:, 2]]
+    normals = np.cross(b - a, c - a)
+    area = np.linalg.norm(normals, axis=1)
+    keep = area > 1e-12 * scale * scale
+    tris, normals, a = tris[keep], normals[keep] / area[keep, None], a[keep]
+    # Face every triangle away from the inside
+    inward = np.einsum('ij,ij->i', normals, a - points[np.unique(tris)].mean(axis=0)) < 0
+    tris[inward] = tris[inward][:, ::-1]
+    normals[inward] *= -1
+    dist = np.einsum('ij,ij->i', normals, a)
+
+    # Coplanar triangles share one plane
+    key = np.round(np.column_stack((normals, dist / scale)), decimals)
+    _, first, plane_of_tri = np.unique(key, axis=0, return_index=True, return_inverse=True)
+    plane_of_tri = plane_of_tri.ravel()
+    planes = np.column_stack((normals[first], dist[first]))
+
+    # Every hull edge is shared by two triangles, edges inside a plane are dropped
+    pairs = np.sort(tris[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    owners = np.repeat(plane_of_tri, 3)
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    pairs, owners = pairs[order], owners[order]
+    start = np.ones(len(pairs), dtype=bool)
+    start[1:] = np.any(pairs[1:] != pairs[:-1], axis=1)
+    group = np.cumsum(start) - 1
+    low = np.full(int(start.sum()), len(planes))
+    high = np.full(int(start.sum()), -1)
+    np.minimum.at(low, group, owners)
+    np.maximum.at(high, group, owners)
+    pairs = pairs[start][low != high]
+    origins = points[pairs[:, 0]]
+    directions = points[pairs[:, 1]] - origins
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    edges = np.column_stack((origins, directions))
+
+    # Only the points on the hull are kept
+    used, tris = np.unique(tris, return_inverse=True)
+    return SurfTables(planes.astype(np.float32), points[used].astype(np.float32),
+                      edges.astype(np.float32), tris.reshape(-1, 3).astype(np.uint32))
+
+def surf_payload(tables, surfindex, flags=0):
+    # Header: index, counts, bounding box and flags, then the four tables
+    planes, points, edges, tris = tables
+    bbox = np.concatenate((points.min(axis=0), points.max(axis=0))) if len(points) else np.zeros(6)
+    header = struct.pack('<5i6fi', surfindex, len(planes), len(points), len(edges), len(tris), *bbox, flags)
+    return header, planes.astype('<f4'), points.astype('<f4'), edges.astype('<f4'), tris.astype('<u4')
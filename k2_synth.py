@@ -0,0 +1,198 @@
+import argparse
+import os
+import struct
+import numpy as np
+
+# bpy-free generator of synthetic SMDL (.model) and CLIP (.clip) files with
+# controllable sizes, used to benchmark the importer and exporter.
+#
+#   python k2_synth.py OUTDIR --verts 10000 --meshes 2 --bones 64 --influences 4 --frames 120
+#
+# Meshes are subdivided grids wrapped around a cylinder, the skeleton is a
+# balanced binary tree of bones named bone000, bone001, ... and the clip
+# animates every bone of that skeleton.
+
+MKEY_COUNT = 10
+MKEY_VISIBILITY = 6
+
+def block(tag, data):
+    return tag + struct.pack('<i', len(data)) + data
+
+def bone_name(index):
+    return f'bone{index:03d}'.encode('utf8')
+
+def bone_parents(num_bones):
+    return [(i - 1) // 2 for i in range(num_bones)]
+
+def bone_offsets(num_bones, rng):
+    # Parent relative rest positions
+    offsets = rng.uniform(-0.2, 0.2, (num_bones, 3)).astype(np.float32)
+    offsets[:, 2] = 0.5
+    if num_bones:
+        offsets[0] = 0.0
+    return offsets
+
+def bone_positions(parents, offsets):
+    positions = offsets.copy()
+    for i, parent in enumerate(parents):
+        if parent >= 0:
+            positions[i] += positions[parent]
+    return positions
+
+def grid_mesh(num_verts, rng):
+    cols = max(2, int(np.sqrt(num_verts)))
+    rows = max(2, num_verts // cols)
+    u, v = np.meshgrid(np.linspace(0.0, 1.0, cols, dtype=np.float32),
+                       np.linspace(0.0, 1.0, rows, dtype=np.float32))
+    u = u.ravel()
+    v = v.ravel()
+    angle = u * np.float32(2 * np.pi)
+    verts = np.column_stack((np.cos(angle), np.sin(angle), v * 4.0)).astype(np.float32)
+    verts += rng.normal(0.0, 0.002, verts.shape).astype(np.float32)
+    normals = np.column_stack((np.cos(angle), np.sin(angle), np.zeros_like(u))).astype(np.float32)
+    tangents = np.column_stack((-np.sin(angle), np.cos(angle), np.zeros_like(u))).astype(np.float32)
+    texc = np.column_stack((u, v)).astype(np.float32)
+
+    quad = (np.arange(rows - 1)[:, None] * cols + np.arange(cols - 1)[None, :]).ravel()
+    faces = np.concatenate((
+        np.column_stack((quad, quad + 1, quad + cols + 1)),
+        np.column_stack((quad, quad + cols + 1, quad + cols)),
+    ))
+    return verts, faces, normals, tangents, texc
+
+def link_data(meshindex, verts, positions, influences, rng):
+    # Weights fall off with the distance to the closest bones
+    num_verts = len(verts)
+    influences = max(1, min(influences, len(positions)))
+    bones = np.empty((num_verts, influences), dtype=np.int64)
+    dist = np.empty((num_verts, influences), dtype=np.float32)
+    for start in range(0, num_verts, 4096):
+        d = np.linalg.norm(verts[start:start + 4096, None, :] - positions[None, :, :], axis=2)
+        nearest = np.argsort(d, axis=1)[:, :influences]
+        bones[start:start + 4096] = nearest
+        dist[start:start + 4096] = np.take_along_axis(d, nearest, axis=1)
+    weights = 1.0 / (dist + 0.1)
+    weights *= rng.uniform(0.9, 1.1, weights.shape)
+    weights = (weights / weights.sum(axis=1, keepdims=True)).astype('<f4')
+    # Every vertex record is: count, count weights, count bone indices
+    record = np.empty((num_verts, 1 + 2 * influences), dtype='<u4')
+    record[:, 0] = influences
+    record[:, 1:1 + influences] = weights.view('<u4')
+    record[:, 1 + influences:] = bones
+    return struct.pack('<ii', meshindex, num_verts) + record.tobytes()
+
+def face_data(meshindex, faces, num_verts):
+    if num_verts < 255:
+        size, dtype = 1, 'u1'
+    elif num_verts < 65536:
+        size, dtype = 2, '<u2'
+    else:
+        size, dtype = 4, '<u4'
+    return struct.pack('<iiB', meshindex, len(faces), size) + faces.astype(dtype).tobytes()
+
+def bone_data(parents, positions):
+    data = b''
+    for i, parent in enumerate(parents):
+        matrix = np.zeros((4, 3), dtype='<f4')
+        matrix[:3] = np.eye(3)
+        inv_matrix = matrix.copy()
+        matrix[3] = positions[i]
+        inv_matrix[3] = -positions[i]
+        name = bone_name(i)
+        data += struct.pack('<i', parent) + inv_matrix.tobytes() + matrix.tobytes()
+        data += struct.pack('B', len(name)) + name + b'\0'
+    return data
+
+def synth_model(num_verts=1000, num_meshes=1, num_bones=32, influences=4, seed=0):
+    rng = np.random.default_rng(seed)
+    parents = bone_parents(num_bones)
+    positions = bone_positions(parents, bone_offsets(num_bones, rng))
+
+    meshes = []
+    for meshindex in range(num_meshes):
+        verts, faces, normals, tangents, texc = grid_mesh(max(num_verts // num_meshes, 4), rng)
+        verts[:, 0] += meshindex * 2.5
+        meshes.append((verts, faces, normals, tangents, texc))
+
+    coords = np.concatenate([mesh[0] for mesh in meshes] + [positions])
+    head = struct.pack('<5i6f', 3, num_meshes, 0, 0, num_bones, *coords.min(axis=0), *coords.max(axis=0))
+    out = [b'SMDL', block(b'head', head)]
+    if num_bones:
+        out.append(block(b'bone', bone_data(parents, positions)))
+
+    for meshindex, (verts, faces, normals, tangents, texc) in enumerate(meshes):
+        name = f'mesh{meshindex}'.encode('utf8')
+        material = f'material{meshindex}'.encode('utf8')
+        header = struct.pack('<iii6fiBB', meshindex, 1, len(verts), *verts.min(axis=0), *verts.max(axis=0),
+                             -1, len(name), len(material))
+        out.append(block(b'mesh', header + name + b'\0' + material + b'\0'))
+        out.append(block(b'vrts', struct.pack('<i', meshindex) + verts.tobytes()))
+        if num_bones:
+            out.append(block(b'lnk1', link_data(meshindex, verts, positions, influences, rng)))
+        out.append(block(b'face', face_data(meshindex, faces, len(verts))))
+        out.append(block(b'texc', struct.pack('<ii', meshindex, 0) + texc.tobytes()))
+        out.append(block(b'tang', struct.pack('<ii', meshindex, 0) + tangents.tobytes()))
+        out.append(block(b'sign', struct.pack('<ii', meshindex, 0) + np.zeros(len(verts), dtype=np.int8).tobytes()))
+        out.append(block(b'nrml', struct.pack('<i', meshindex) + normals.tobytes()))
+    return b''.join(out)
+
+def synth_clip(num_bones=32, num_frames=60, seed=0):
+    # Same skeleton as synth_model with the same seed
+    rng = np.random.default_rng(seed)
+    offsets = bone_offsets(num_bones, rng)
+    t = np.arange(num_frames, dtype=np.float32) / max(num_frames, 1) * np.float32(2 * np.pi)
+
+    out = [b'CLIP', block(b'head', struct.pack('<3i', 2, num_bones, num_frames))]
+    for index in range(num_bones):
+        phase = np.float32(index * 0.37)
+        channels = [
+            offsets[index, 0] + 0.05 * np.sin(t + phase),
+            offsets[index, 1] + 0.05 * np.cos(t + phase),
+            np.full(1, offsets[index, 2]),
+            20.0 * np.sin(t + phase),
+            10.0 * np.sin(2 * t + phase),
+            30.0 * np.cos(t + phase),
+            np.full(1, 255),
+            np.ones(1),
+            np.ones(1),
+            np.ones(1),
+        ]
+        name = bone_name(index)
+        for keytype, keys in enumerate(channels):
+            keys = keys.astype('u1' if keytype == MKEY_VISIBILITY else '<f4')
+            header = struct.pack('<3iB', index, keytype, len(keys), len(name)) + name + b'\0'
+            out.append(block(b'bmtn', header + keys.tobytes()))
+    return b''.join(out)
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def write_model(path, num_verts=1000, num_meshes=1, num_bones=32, influences=4, seed=0):
+    return write_file(path, synth_model(num_verts, num_meshes, num_bones, influences, seed))
+
+def write_clip(path, num_bones=32, num_frames=60, seed=0):
+    return write_file(path, synth_clip(num_bones, num_frames, seed))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic K2 model and clip.')
+    parser.add_argument('outdir')
+    parser.add_argument('--name', default='synth', help='base name of the written files')
+    parser.add_argument('--verts', type=int, default=1000, help='total vertex count')
+    parser.add_argument('--meshes', type=int, default=1)
+    parser.add_argument('--bones', type=int, default=32)
+    parser.add_argument('--influences', type=int, default=4, help='bone influences per vertex')
+    parser.add_argument('--frames', type=int, default=60, help='clip frame count, 0 for no clip')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    model = write_model(os.path.join(args.outdir, f'{args.name}.model'), args.verts, args.meshes,
+                        args.bones, args.influences, args.seed)
+    print(model)
+    if args.frames > 0 and args.bones > 0:
+        print(write_clip(os.path.join(args.outdir, f'{args.name}.clip'), args.bones, args.frames, args.seed))
+
+if __name__ == '__main__':
+    main()
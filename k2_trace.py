@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Logging and phase timing shared by the importers, bpy-free.
+#
+# Messages are %-style format strings with separate arguments and are only
+# formatted when their level is enabled. Timing spans are recorded into the
+# active Trace, started by an operator with tracing(); without one, span() is
+# a no-op.
+
+# 0 quiet, 1 errors and warnings, 2 verbose, 3 debug
+LOG_LEVEL = 1
+
+def log(msg, *args):
+    if LOG_LEVEL >= 1:
+        print(msg % args if args else msg)
+
+def vlog(msg, *args):
+    if LOG_LEVEL >= 2:
+        print(msg % args if args else msg)
+
+def dlog(msg, *args):
+    if LOG_LEVEL >= 3:
+        print(msg % args if args else msg)
+
+def err(msg, *args):
+    log('ERROR: ' + msg, *args)
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.start = time.perf_counter()
+        self.local = threading.local()
+        self.previous = None
+
+    @contextmanager
+    def span(self, name, **info):
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.local.depth = depth
+            # list.append is atomic, spans may come from decoder threads
+            self.spans.append((name, start - self.start, end - start, depth, threading.get_ident(), info))
+
+    def summary(self):
+        # Per span name: count, total and longest duration, in order of first use
+        totals = {}
+        for name, _, duration, _, _, _ in sorted(self.spans, key=lambda s: s[1]):
+            count, total, longest = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (count + 1, total + duration, max(longest, duration))
+        return totals
+
+    def summary_lines(self):
+        lines = [f'{self.name}: {time.perf_counter() - self.start:.3f}s']
+        for name, (count, total, longest) in self.summary().items():
+            if count == 1:
+                lines.append(f'  {name}: {total * 1000:.1f} ms')
+            else:
+                lines.append(f'  {name}: {total * 1000:.1f} ms in {count} spans, longest {longest * 1000:.1f} ms')
+        return lines
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'summary': {name: {'count': count, 'total': total, 'max': longest}
+                        for name, (count, total, longest) in self.summary().items()},
+            'spans': [{'name': name, 'start': start, 'duration': duration, 'depth': depth, 'thread': thread, **info}
+                      for name, start, duration, depth, thread, info in self.spans],
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+active = None
+NO_SPAN = nullcontext()
+
+def begin_trace(name):
+    # For traces that outlive a single call, such as modal operators
+    global active
+    trace = Trace(name)
+    trace.previous = active
+    active = trace
+    return trace
+
+def end_trace(trace):
+    global active
+    if active is trace:
+        active = trace.previous
+
+@contextmanager
+def tracing(name):
+    trace = begin_trace(name)
+    try:
+        yield trace
+    finally:
+        end_trace(trace)
+
+def span(name, **info):
+    if active is None:
+        return NO_SPAN
+    return active.span(name, **info)
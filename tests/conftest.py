@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bpy-free modules are imported on their own, as the command line tools do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import numpy as np
+
+import k2_cache
+import k2_decode
+import k2_synth
+
+def test_entry_round_trip(tmp_path):
+    path = str(tmp_path / 'entry.k2c')
+    arrays = {
+        'floats': np.arange(12, dtype=np.float32).reshape(4, 3),
+        'bytes': np.arange(5, dtype=np.uint8),
+        'empty': np.empty((0, 3), dtype=np.int32),
+        'big': np.arange(100, dtype='<u8'),
+    }
+    k2_cache.write_entry(path, {'kind': 'test', 'names': ['a', 'b']}, arrays)
+    meta, loaded = k2_cache.read_entry(path)
+    assert meta == {'kind': 'test', 'names': ['a', 'b']}
+    assert list(loaded) == list(arrays)
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        np.testing.assert_array_equal(loaded[name], array)
+        if array.size:
+            assert loaded[name].__array_interface__['data'][0] % k2_cache.ALIGNMENT == 0
+
+def test_model_round_trip(tmp_path):
+    path = k2_synth.write_model(str(tmp_path / 'synth.model'), num_verts=300, num_meshes=2, num_bones=8)
+    with k2_decode.ChunkFile(path) as model:
+        data = k2_decode.decode_model(model)
+    cache = k2_cache.DecodeCache(str(tmp_path / 'cache'))
+    key = cache.key(path, 'model', flipuv=True)
+    assert cache.load_model(key) is None
+    cache.store_model(key, data)
+    loaded = cache.load_model(key)
+    assert loaded.header == data.header
+    assert loaded.bones.names == data.bones.names
+    np.testing.assert_array_equal(loaded.bones.matrices, data.bones.matrices)
+    for mesh, other in zip(loaded.meshes, data.meshes):
+        assert mesh[:5] == other[:5]
+        for field in ('verts', 'faces', 'normals', 'texcoords'):
+            np.testing.assert_array_equal(getattr(mesh, field), getattr(other, field))
+        for (bone, verts, weights), (other_bone, other_verts, other_weights) in zip(mesh.links, other.links):
+            assert bone == other_bone
+            np.testing.assert_array_equal(verts, other_verts)
+            np.testing.assert_array_equal(weights, other_weights)
+    assert cache.load_clip(key) is None
+    # Other options are another entry
+    assert cache.key(path, 'model', flipuv=False) != key
+
+def test_clip_round_trip(tmp_path):
+    path = k2_synth.write_clip(str(tmp_path / 'synth.clip'), num_bones=4, num_frames=12)
+    with k2_decode.ChunkFile(path) as clip:
+        data = k2_decode.decode_clip(clip)
+    cache = k2_cache.DecodeCache(str(tmp_path / 'cache'))
+    key = cache.key(path, 'clip')
+    cache.store_clip(key, data)
+    loaded = cache.load_clip(key)
+    assert loaded[:4] == data[:4]
+    np.testing.assert_array_equal(loaded.channels, data.channels)
+
+def test_evict(tmp_path):
+    cache = k2_cache.DecodeCache(str(tmp_path / 'cache'), max_bytes=3000)
+    for i in range(5):
+        cache.store(f'key{i}', {'kind': 'test'}, {'data': np.zeros(100, dtype=np.float64)})
+    sizes = [entry.stat().st_size for entry in (tmp_path / 'cache').iterdir()]
+    assert 0 < len(sizes) < 5
+    assert sum(sizes) <= 3000
+    cache.clear()
+    assert not list((tmp_path / 'cache').iterdir())
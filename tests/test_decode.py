@@ -0,0 +1,200 @@
+import struct
+import numpy as np
+import pytest
+
+import k2_decode
+import k2_synth
+
+##############################
+# LNK1
+##############################
+
+def links_payload(meshindex, influences):
+    # influences holds the (weight, bone) pairs of every vertex
+    data = struct.pack('<ii', meshindex, len(influences))
+    for pairs in influences:
+        data += struct.pack('<i', len(pairs))
+        data += b''.join(struct.pack('<f', weight) for weight, _ in pairs)
+        data += b''.join(struct.pack('<I', bone) for _, bone in pairs)
+    return data
+
+def reference_links(payload):
+    # One vertex record at a time, as the importer read lnk1 blocks before numpy
+    numverts = struct.unpack_from('<i', payload, 4)[0]
+    verts, weights, indexes = [], [], []
+    offset = 8
+    for vert in range(numverts):
+        count = struct.unpack_from('<i', payload, offset)[0]
+        weights += struct.unpack_from(f'<{count}f', payload, offset + 4)
+        indexes += struct.unpack_from(f'<{count}I', payload, offset + 4 + 4 * count)
+        verts += [vert] * count
+        offset += 4 + 8 * count
+    return verts, weights, indexes
+
+def random_influences(counts, seed=0):
+    rng = np.random.default_rng(seed)
+    return [list(zip(rng.random(count, dtype=np.float32).tolist(), rng.integers(0, 300, count).tolist()))
+            for count in counts]
+
+def assert_links_equal(decoded, expected):
+    verts, weights, indexes = decoded
+    assert verts.dtype == np.int32
+    assert weights.dtype == np.float32
+    assert indexes.dtype == np.uint32
+    np.testing.assert_array_equal(verts, expected[0])
+    np.testing.assert_array_equal(weights, np.array(expected[1], dtype=np.float32))
+    np.testing.assert_array_equal(indexes, expected[2])
+
+@pytest.mark.parametrize('width', [0, 1, 2, 4, 8])
+def test_links_fixed_width(width):
+    payload = links_payload(3, random_influences([width] * 50))
+    assert_links_equal(k2_decode.decode_links(payload), reference_links(payload))
+
+@pytest.mark.parametrize('counts', [
+    [1, 2, 3, 4],
+    [4, 1, 1, 1],            # the first record is wider than the rest, the table overruns the payload
+    [2, 2, 2, 2, 2, 3],      # the table fits, the last count differs
+    [3, 0, 3, 0],
+    [2],
+])
+def test_links_mixed_counts(counts):
+    payload = links_payload(0, random_influences(counts * 10))
+    assert_links_equal(k2_decode.decode_links(payload), reference_links(payload))
+
+def test_links_fixed_width_matches_mixed_counts():
+    # The same influences decoded by the table path and, after one wider vertex
+    # is appended, by the per-vertex path
+    influences = random_influences([4] * 200, seed=1)
+    uniform = k2_decode.decode_links(links_payload(0, influences))
+    mixed = k2_decode.decode_links(links_payload(0, influences + random_influences([5], seed=2)))
+    for fast, slow in zip(uniform, mixed):
+        assert fast.dtype == slow.dtype
+        np.testing.assert_array_equal(fast, slow[:len(fast)])
+
+def test_links_empty():
+    verts, weights, indexes = k2_decode.decode_links(struct.pack('<ii', 0, 0))
+    assert len(verts) == len(weights) == len(indexes) == 0
+
+def test_group_links():
+    payload = links_payload(0, [[(0.75, 7), (0.25, 2)], [(1.0, 2)], [(0.5, 7), (0.5, 9)]])
+    groups = k2_decode.group_links(*k2_decode.decode_links(payload))
+    assert [bone for bone, _, _ in groups] == [7, 2, 9]
+    np.testing.assert_array_equal(groups[0][1], [0, 2])
+    np.testing.assert_array_equal(groups[0][2], [0.75, 0.5])
+    np.testing.assert_array_equal(groups[1][1], [0, 1])
+    np.testing.assert_array_equal(groups[2][1], [2])
+
+##############################
+# MODELS
+##############################
+
+@pytest.fixture(scope='module')
+def synth_model_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('models') / 'synth.model'
+    return k2_synth.write_model(str(path), num_verts=2000, num_meshes=2, num_bones=16, influences=3)
+
+def test_index_chunks(synth_model_path):
+    with k2_decode.ChunkFile(synth_model_path) as model:
+        assert model.signature == b'SMDL'
+        tags = [entry.tag for entry in model.chunks]
+        assert tags[:2] == [b'head', b'bone']
+        assert tags.count(b'mesh') == 2
+        assert all(entry.mesh == -1 for entry in model.chunks[:2])
+        last = model.chunks[-1]
+        assert last.offset + last.size == len(model.view)
+        assert model.find(b'vrts', mesh=1).mesh == 1
+
+def test_links_of_synth_model(synth_model_path):
+    with k2_decode.ChunkFile(synth_model_path) as model:
+        for entry in model.chunks:
+            if entry.tag == b'lnk1':
+                payload = model.chunk(entry).view
+                assert_links_equal(k2_decode.decode_links(payload), reference_links(payload))
+
+def test_decode_model(synth_model_path):
+    with k2_decode.ChunkFile(synth_model_path) as model:
+        data = k2_decode.decode_model(model, workers=1)
+        threaded = k2_decode.decode_model(model, workers=2)
+    assert data.header.version == 3
+    assert data.header.num_meshes == len(data.meshes) == 2
+    assert data.bones.names == [f'bone{i:03d}' for i in range(16)]
+    np.testing.assert_array_equal(data.bones.parents, k2_synth.bone_parents(16))
+    for mesh, other in zip(data.meshes, threaded.meshes):
+        assert mesh.name == f'mesh{mesh.index}'
+        assert mesh.material == f'material{mesh.index}'
+        num_verts = len(mesh.verts)
+        assert mesh.normals.shape == (num_verts, 3)
+        assert mesh.faces.max() < num_verts
+        assert mesh.texcoords.shape == (mesh.faces.size, 2)
+        # Every vertex has three influences that sum to one
+        weights = np.zeros(num_verts)
+        influences = np.zeros(num_verts, dtype=np.int64)
+        for bone, verts, bone_weights in mesh.links:
+            np.add.at(weights, verts, bone_weights)
+            np.add.at(influences, verts, 1)
+        np.testing.assert_allclose(weights, 1.0, atol=1e-5)
+        assert np.all(influences == 3)
+        np.testing.assert_array_equal(mesh.verts, other.verts)
+        np.testing.assert_array_equal(mesh.faces, other.faces)
+
+def test_summarize_mesh(synth_model_path):
+    with k2_decode.ChunkFile(synth_model_path) as model:
+        data = k2_decode.decode_model(model)
+        groups = k2_decode.mesh_entry_groups(model.chunks)
+        summaries = [k2_decode.summarize_mesh(model, group, data.header.version) for group in groups]
+    for summary, mesh in zip(summaries, data.meshes):
+        assert summary.kind == 'mesh'
+        assert (summary.index, summary.name, summary.material) == (mesh.index, mesh.name, mesh.material)
+        assert (summary.num_verts, summary.num_faces) == (len(mesh.verts), len(mesh.faces))
+
+@pytest.mark.parametrize('num_verts, dtype', [(100, np.uint8), (1000, np.dtype('<u2')), (70000, np.dtype('<u4'))])
+def test_decode_faces(num_verts, dtype):
+    faces = np.arange(30).reshape(10, 3) * (num_verts // 40)
+    payload = k2_synth.face_data(0, faces, num_verts)
+    decoded = k2_decode.decode_faces(payload, 3)
+    assert decoded.dtype == dtype
+    np.testing.assert_array_equal(decoded, faces)
+
+##############################
+# CLIPS
+##############################
+
+def read_clip(path):
+    with k2_decode.ChunkFile(path) as clip:
+        return k2_decode.decode_clip(clip)
+
+def test_decode_clip(tmp_path):
+    path = k2_synth.write_clip(str(tmp_path / 'synth.clip'), num_bones=8, num_frames=30)
+    data = read_clip(path)
+    assert (data.version, data.num_bones, data.num_frames) == (2, 8, 30)
+    assert data.names == [f'bone{i:03d}' for i in range(8)]
+    assert data.channels.shape == (8, k2_decode.MKEY_COUNT, 30)
+    assert data.channels.dtype == np.float32
+    # Single key channels hold their key on every frame
+    offsets = k2_synth.bone_offsets(8, np.random.default_rng(0))
+    np.testing.assert_array_equal(data.channels[:, k2_decode.MKEY_Z], np.repeat(offsets[:, 2:], 30, axis=1))
+    assert np.all(data.channels[:, k2_decode.MKEY_VISIBILITY] == 255)
+    assert np.all(data.channels[:, k2_decode.MKEY_SCALE_X:] == 1)
+    t = np.arange(30, dtype=np.float32) / 30 * np.float32(2 * np.pi)
+    np.testing.assert_allclose(data.channels[3, k2_decode.MKEY_PITCH], 20.0 * np.sin(t + np.float32(3 * 0.37)), rtol=1e-5, atol=1e-5)
+
+def clip_v1_block(name, index, keytype, keys):
+    header = name.ljust(32, b'\0') + struct.pack('<3i', index, keytype, len(keys))
+    return k2_synth.block(b'bmtn', header + np.asarray(keys, dtype='<f4').tobytes())
+
+def test_decode_clip_version_1(tmp_path):
+    # Version 1 stores fixed 32 byte names and a uniform scale in the x channel
+    data = b'CLIP' + k2_synth.block(b'head', struct.pack('<3i', 1, 2, 4))
+    data += clip_v1_block(b'root', 0, k2_decode.MKEY_SCALE_X, [2.0])
+    data += clip_v1_block(b'root', 0, k2_decode.MKEY_X, [1.0, 2.0])
+    data += clip_v1_block(b'arm', 1, k2_decode.MKEY_YAW, [10.0, 20.0, 30.0, 40.0, 50.0])
+    path = tmp_path / 'v1.clip'
+    path.write_bytes(data)
+    clip = read_clip(str(path))
+    assert clip.names == ['root', 'arm']
+    np.testing.assert_array_equal(clip.channels[0, k2_decode.MKEY_SCALE_X:], 2.0)
+    np.testing.assert_array_equal(clip.channels[1, k2_decode.MKEY_SCALE_X:], 1.0)
+    # Short channels repeat their last key, extra keys are ignored
+    np.testing.assert_array_equal(clip.channels[0, k2_decode.MKEY_X], [1.0, 2.0, 2.0, 2.0])
+    np.testing.assert_array_equal(clip.channels[1, k2_decode.MKEY_YAW], [10.0, 20.0, 30.0, 40.0])
+    np.testing.assert_array_equal(clip.channels[1, k2_decode.MKEY_X], 0.0)
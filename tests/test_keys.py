@@ -0,0 +1,62 @@
+import math
+import numpy as np
+import pytest
+
+import k2_keys
+
+def interpolate(keys, num_frames):
+    # Linear interpolation of the reduced keys on every frame, as the LINEAR F-Curves evaluate
+    frames = np.arange(num_frames)
+    return np.column_stack([np.interp(frames, key_frames, key_values) for key_frames, key_values in keys])
+
+def max_error(values, keys):
+    return np.linalg.norm(interpolate(keys, len(values)) - values, axis=1).max()
+
+def test_quaternion_tolerance():
+    angle = math.radians(3.0)
+    q = np.array([1.0, 0.0, 0.0, 0.0])
+    r = np.array([math.cos(angle / 2), math.sin(angle / 2), 0.0, 0.0])
+    assert k2_keys.quaternion_tolerance(angle) == pytest.approx(np.linalg.norm(q - r))
+
+def test_linear_motion_keeps_the_ends():
+    values = np.column_stack((np.linspace(0.0, 1.0, 50), np.linspace(2.0, -2.0, 50)))
+    for frames, _ in k2_keys.reduce_keys(values, k2_keys.LOCATION_TOLERANCE):
+        np.testing.assert_array_equal(frames, [0, 49])
+
+def test_constant_component_has_one_key():
+    t = np.linspace(0.0, 2 * np.pi, 40)
+    values = np.column_stack((np.sin(t), np.full(40, 3.0), 3.0 + 0.5e-4 * np.sin(3 * t)))
+    keys = k2_keys.reduce_keys(values, 1e-4)
+    assert len(keys[0][0]) > 2
+    for frames, key_values in keys[1:]:
+        np.testing.assert_array_equal(frames, [0])
+    assert keys[1][1][0] == 3.0
+    assert max_error(values, keys) <= 1e-4
+
+@pytest.mark.parametrize('seed', range(5))
+def test_error_within_tolerance(seed):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0.0, 1.0, 120)[:, None]
+    values = np.sin(t * rng.uniform(1, 20, 4) + rng.uniform(0, 6, 4)) + rng.normal(0, 1e-4, (120, 4))
+    # Some components only jitter around a constant
+    values[:, rng.integers(0, 4)] = 0.25 + rng.uniform(-4e-4, 4e-4, 120)
+    for tolerance in (1e-4, 1e-3, 1e-2):
+        keys = k2_keys.reduce_keys(values, tolerance)
+        assert max_error(values, keys) <= tolerance * (1 + 1e-9)
+        # Components that are not constant share their keyed frames
+        varying = [frames for frames, _ in keys if len(frames) > 1]
+        assert all(np.array_equal(frames, varying[0]) for frames in varying)
+
+def test_constants_are_not_collapsed_past_the_tolerance():
+    # Every component alone is within the tolerance, together they are not
+    tolerance = 1e-3
+    values = np.tile([[0.0] * 5, [tolerance] * 5], (10, 1))
+    keys = k2_keys.reduce_keys(values, tolerance)
+    assert all(len(frames) > 1 for frames, _ in keys)
+    assert max_error(values, keys) <= tolerance
+
+def test_few_frames():
+    assert [len(frames) for frames, _ in k2_keys.reduce_keys(np.zeros((0, 3)), 0.1)] == [0, 0, 0]
+    keys = k2_keys.reduce_keys(np.array([[1.0, 0.0], [2.0, 0.0]]), 0.1)
+    np.testing.assert_array_equal(keys[0][0], [0, 1])
+    np.testing.assert_array_equal(keys[1][0], [0])
@@ -0,0 +1,48 @@
+import numpy as np
+
+import k2_optimize
+
+def grid_faces(cols, rows):
+    quad = (np.arange(rows - 1)[:, None] * cols + np.arange(cols - 1)[None, :]).ravel()
+    return np.concatenate((np.column_stack((quad, quad + 1, quad + cols + 1)),
+                           np.column_stack((quad, quad + cols + 1, quad + cols))))
+
+def sorted_rows(faces):
+    return faces[np.lexsort(faces.T[::-1])]
+
+def test_acmr():
+    assert k2_optimize.acmr(np.empty((0, 3), dtype=np.int64)) == 0.0
+    assert k2_optimize.acmr(np.array([[0, 1, 2]])) == 3.0
+    assert k2_optimize.acmr(np.array([[0, 1, 2], [2, 1, 3]])) == 2.0
+    # Vertex 0 is evicted from a three entry cache before it is used again
+    assert k2_optimize.acmr(np.array([[0, 1, 2], [3, 4, 0]]), cache_size=3) == 3.0
+    assert k2_optimize.acmr(np.array([[0, 1, 2], [3, 4, 0]]), cache_size=5) == 2.5
+
+def test_optimize_vertex_cache():
+    rng = np.random.default_rng(0)
+    cols = rows = 64
+    faces = grid_faces(cols, rows)
+    # Shuffled triangles and vertex numbers
+    shuffle = rng.permutation(cols * rows)
+    faces = shuffle[faces][rng.permutation(len(faces))]
+    before = k2_optimize.acmr(faces)
+    new_faces, order = k2_optimize.optimize_vertex_cache(faces, cols * rows)
+    after = k2_optimize.acmr(new_faces)
+    assert before > 2.5
+    assert after < 0.8
+    # The same triangles with the same winding
+    assert new_faces.shape == faces.shape
+    np.testing.assert_array_equal(sorted_rows(order[new_faces]), sorted_rows(faces))
+
+def test_tipsify_is_a_permutation():
+    faces = grid_faces(10, 7)
+    order = k2_optimize.tipsify(faces, 70, cache_size=8)
+    np.testing.assert_array_equal(np.sort(order), np.arange(len(faces)))
+
+def test_first_use_order():
+    faces = np.array([[5, 2, 7], [2, 0, 5]])
+    new_faces, order = k2_optimize.first_use_order(faces, 9)
+    np.testing.assert_array_equal(new_faces, [[0, 1, 2], [1, 3, 0]])
+    # Unused vertices go last
+    np.testing.assert_array_equal(order, [5, 2, 7, 0, 1, 3, 4, 6, 8])
+    np.testing.assert_array_equal(order[new_faces], faces)
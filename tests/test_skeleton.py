@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import k2_decode
+import k2_skeleton
+
+def rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def rotation_y(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+def rotation_z(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+def quaternion_matrix(q):
+    w, x, y, z = q
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+    ])
+
+def translation(x, y, z):
+    m = np.eye(4)
+    m[:3, 3] = x, y, z
+    return m
+
+def test_bone_depths():
+    assert k2_skeleton.bone_depths([-1, 0, 1, 0]) == [0, 1, 2, 1]
+    assert k2_skeleton.bone_depths([2, -1, 1, -1]) == [2, 0, 1, 0]
+
+def test_build_table():
+    # Children listed before their parents
+    names = ['hand', 'root', 'arm']
+    parents = [2, -1, 1]
+    rest = np.stack((translation(0, 0, 3), translation(0, 0, 1), translation(0, 1, 2)))
+    rest[2, :3, :3] = rotation_z(0.5)
+    table = k2_skeleton.build_table(names, parents, rest)
+    assert table.names == ['root', 'arm', 'hand']
+    assert table.index == {'root': 0, 'arm': 1, 'hand': 2}
+    np.testing.assert_array_equal(table.parents, [-1, 0, 1])
+    np.testing.assert_allclose(table.rest[1] @ table.local_rest[2], table.rest[2], atol=1e-12)
+    np.testing.assert_allclose(table.local_rest[0], table.rest[0])
+    np.testing.assert_allclose(table.inv_local_rest @ table.local_rest, np.broadcast_to(np.eye(4), (3, 4, 4)), atol=1e-12)
+
+def test_euler_yxz_matrices():
+    rng = np.random.default_rng(0)
+    pitch, roll, yaw = rng.uniform(-np.pi, np.pi, (3, 20))
+    matrices = k2_skeleton.euler_yxz_matrices(pitch, roll, yaw)
+    for m, x, y, z in zip(matrices, pitch, roll, yaw):
+        np.testing.assert_allclose(m, rotation_z(z) @ rotation_x(x) @ rotation_y(y), atol=1e-12)
+
+def test_matrix_to_quaternion():
+    rng = np.random.default_rng(0)
+    q = rng.normal(size=(200, 4))
+    # Rotations by nearly 180 degrees take the other extraction formulas
+    q[:50, 0] *= 1e-4
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    q[q[:, 0] < 0] *= -1
+    matrices = np.stack([quaternion_matrix(row) for row in q])
+    result = k2_skeleton.matrix_to_quaternion(matrices)
+    assert np.all(result[:, 0] >= 0)
+    np.testing.assert_allclose(result, q, atol=1e-9)
+    np.testing.assert_allclose(k2_skeleton.matrix_to_quaternion(np.eye(3)), [1, 0, 0, 0])
+
+def test_clip_pose():
+    rest = np.stack((translation(0, 0, 0), translation(1, 0, 0)))
+    rest[1, :3, :3] = rotation_x(0.3)
+    skeleton = k2_skeleton.build_table(['root', 'arm'], [-1, 0], rest)
+    rng = np.random.default_rng(0)
+    channels = np.zeros((3, k2_decode.MKEY_COUNT, 5), dtype=np.float32)
+    channels[:, :3] = rng.normal(size=(3, 3, 5))
+    channels[:, 3:6] = rng.uniform(-90, 90, (3, 3, 5))
+    clip = k2_decode.ClipData(2, 3, 5, ['arm', 'missing', 'root'], channels)
+
+    names, quats, locs = k2_skeleton.clip_pose(clip, skeleton)
+    assert names == ['arm', 'root']
+    assert quats.shape == (2, 5, 4) and locs.shape == (2, 5, 3)
+    for row, name in zip((0, 2), names):
+        inv_rest = skeleton.inv_local_rest[skeleton.index[name]]
+        for frame in range(5):
+            pitch, roll, yaw = np.radians(channels[row, 3:6, frame].astype(np.float64))
+            transform = translation(*channels[row, :3, frame].astype(np.float64))
+            transform[:3, :3] = rotation_z(yaw) @ rotation_x(pitch) @ rotation_y(roll)
+            expected = inv_rest @ transform
+            pose = quaternion_matrix(quats[names.index(name), frame])
+            np.testing.assert_allclose(pose, expected[:3, :3], atol=1e-9)
+            np.testing.assert_allclose(locs[names.index(name), frame], expected[:3, 3], atol=1e-9)
+
+def test_clip_pose_without_bones():
+    skeleton = k2_skeleton.build_table(['root'], [-1], np.eye(4)[None])
+    clip = k2_decode.ClipData(2, 1, 4, ['other'], np.zeros((1, k2_decode.MKEY_COUNT, 4), dtype=np.float32))
+    names, quats, locs = k2_skeleton.clip_pose(clip, skeleton)
+    assert names == []
+    assert quats.shape == (0, 4, 4) and locs.shape == (0, 4, 3)
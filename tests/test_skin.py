@@ -0,0 +1,50 @@
+import numpy as np
+
+import k2_skin
+
+def test_gather_influences():
+    verts, groups, weights = k2_skin.gather_influences([[(2, 0.5), (0, 0.25)], [], [(1, 1.0)]])
+    np.testing.assert_array_equal(verts, [0, 0, 2])
+    np.testing.assert_array_equal(groups, [2, 0, 1])
+    np.testing.assert_array_equal(weights, [0.5, 0.25, 1.0])
+    assert weights.dtype == np.float32
+
+def test_limit_influences():
+    verts = np.array([0, 0, 0, 0, 0, 0, 1, 1, 2, 2, 3])
+    bones = np.array([1, 2, 3, 4, 5, 6, 7, -1, 8, 9, 10])
+    weights = np.array([0.1, 0.6, 0.2, 0.3, 0.05, 0.4, 0.5, 0.9, 0.004, 0.002, 0.5], dtype=np.float32)
+    skin, clamped = k2_skin.limit_influences(5, verts, bones, weights, max_influences=4, threshold=0.01)
+    assert clamped == 1
+    np.testing.assert_array_equal(skin.counts, [4, 1, 1, 1, 0])
+    # Strongest first, capped at four and normalized
+    np.testing.assert_array_equal(skin.bones[0], [2, 6, 4, 3])
+    np.testing.assert_allclose(skin.weights[0], np.array([0.6, 0.4, 0.3, 0.2]) / 1.5, rtol=1e-6)
+    # Groups without a bone are dropped
+    np.testing.assert_array_equal(skin.bones[1], [7, -1, -1, -1])
+    # The strongest influence is kept even below the threshold
+    np.testing.assert_array_equal(skin.bones[2], [8, -1, -1, -1])
+    np.testing.assert_allclose(skin.weights[2], [1.0, 0.0, 0.0, 0.0])
+    # Vertices without influences keep zero weights
+    np.testing.assert_array_equal(skin.weights[4], 0.0)
+
+def test_limit_influences_random():
+    rng = np.random.default_rng(0)
+    num_verts = 500
+    counts = rng.integers(0, 9, num_verts)
+    verts = np.repeat(np.arange(num_verts), counts)
+    weights = rng.random(len(verts), dtype=np.float32)
+    skin, clamped = k2_skin.limit_influences(num_verts, verts, rng.integers(0, 60, len(verts)), weights, 3, 0.05)
+    assert clamped <= np.count_nonzero(counts > 3)
+    assert skin.bones.shape == skin.weights.shape == (num_verts, 3)
+    np.testing.assert_array_equal(skin.counts, np.minimum(skin.counts, 3))
+    np.testing.assert_array_equal(skin.counts > 0, counts > 0)
+    used = np.arange(3) < skin.counts[:, None]
+    assert np.all(skin.bones[~used] == -1) and np.all(skin.weights[~used] == 0)
+    np.testing.assert_allclose(skin.weights.sum(axis=1)[counts > 0], 1.0, rtol=1e-5)
+    assert np.all(np.diff(skin.weights, axis=1)[used[:, 1:]] <= 0)
+
+def test_take():
+    skin, _ = k2_skin.limit_influences(3, np.array([0, 1, 2]), np.array([4, 5, 6]), np.ones(3, dtype=np.float32))
+    taken = k2_skin.take(skin, [2, 0])
+    np.testing.assert_array_equal(taken.bones[:, 0], [6, 4])
+    np.testing.assert_array_equal(taken.counts, [1, 1])
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import k2_surf
+
+CUBE_POINTS = [(x, y, z) for x in (-1.0, 1.0) for y in (-1.0, 1.0) for z in (-1.0, 1.0)]
+CUBE_TRIS = [(0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1),
+             (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3)]
+
+OCTAHEDRON_POINTS = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
+OCTAHEDRON_TRIS = [(0, 2, 4), (2, 1, 4), (1, 3, 4), (3, 0, 4), (2, 0, 5), (1, 2, 5), (3, 1, 5), (0, 3, 5)]
+
+def check_hull(tables):
+    planes, points, edges, tris = tables
+    normals, dist = planes[:, :3], planes[:, 3]
+    tolerance = 1e-5 * max(1.0, float(np.abs(points).max()))
+    np.testing.assert_allclose(np.linalg.norm(normals, axis=1), 1.0, rtol=1e-6)
+    # Every point is inside or on every plane, every plane touches the hull
+    side = points @ normals.T - dist
+    assert np.all(side <= tolerance)
+    assert np.all(np.abs(side).min(axis=0) <= tolerance)
+    # Triangles face out
+    a, b, c = points[tris[:, 0]], points[tris[:, 1]], points[tris[:, 2]]
+    tri_normals = np.cross(b - a, c - a)
+    assert np.all(np.einsum('ij,ij->i', tri_normals, a - points.mean(axis=0)) > 0)
+    # Edges lie on the hull and have unit directions
+    np.testing.assert_allclose(np.linalg.norm(edges[:, 3:], axis=1), 1.0, rtol=1e-6)
+    assert np.all(np.abs(edges[:, :3] @ normals.T - dist).min(axis=1) <= tolerance)
+
+def test_cube():
+    tables = k2_surf.surf_tables(CUBE_POINTS, CUBE_TRIS)
+    assert [len(table) for table in tables] == [6, 8, 12, 12]
+    check_hull(tables)
+    np.testing.assert_allclose(tables.planes[:, 3], 1.0)
+
+def test_mixed_winding():
+    tris = [tri[::-1] if i % 3 == 0 else tri for i, tri in enumerate(CUBE_TRIS)]
+    tables = k2_surf.surf_tables(CUBE_POINTS, tris)
+    check_hull(tables)
+    reference = k2_surf.surf_tables(CUBE_POINTS, CUBE_TRIS)
+    np.testing.assert_array_equal(tables.planes, reference.planes)
+
+def test_octahedron():
+    tables = k2_surf.surf_tables(OCTAHEDRON_POINTS, OCTAHEDRON_TRIS)
+    assert [len(table) for table in tables] == [8, 6, 12, 8]
+    check_hull(tables)
+    np.testing.assert_allclose(tables.planes[:, 3], 1 / np.sqrt(3), rtol=1e-6)
+
+def test_unused_points_and_degenerate_triangles():
+    points = CUBE_POINTS + [(0.0, 0.0, 0.0)]
+    tris = CUBE_TRIS + [(0, 0, 1)]
+    tables = k2_surf.surf_tables(points, tris)
+    assert [len(table) for table in tables] == [6, 8, 12, 12]
+    assert tables.tris.max() == 7
+
+@pytest.mark.parametrize('seed', range(3))
+def test_scaled_box(seed):
+    rng = np.random.default_rng(seed)
+    points = np.array(CUBE_POINTS) * rng.uniform(0.01, 100, 3) + rng.uniform(-50, 50, 3)
+    tables = k2_surf.surf_tables(points, CUBE_TRIS)
+    assert [len(table) for table in tables] == [6, 8, 12, 12]
+    check_hull(tables)
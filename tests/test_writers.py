@@ -0,0 +1,158 @@
+import struct
+from io import BytesIO
+import numpy as np
+import pytest
+
+import k2_decode
+import k2_skin
+import k2_surf
+import k2_synth
+
+def block_bytes(payload):
+    # A (header, array, ...) payload as the bytes write_block streams out
+    return b''.join(part.tobytes() if isinstance(part, np.ndarray) else part for part in payload)
+
+def random_skin(num_verts, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 7, num_verts)
+    verts = np.repeat(np.arange(num_verts), counts)
+    bones = rng.integers(0, 40, len(verts))
+    weights = rng.random(len(verts), dtype=np.float32)
+    skin, _ = k2_skin.limit_influences(num_verts, verts, bones, weights)
+    return skin
+
+##############################
+# LNK1
+##############################
+
+def reference_lnk1(skin, meshindex):
+    # Per-vertex struct.pack output of the exporter before k2_skin
+    data = struct.pack('<ii', meshindex, len(skin.counts))
+    for bones, weights, count in zip(skin.bones, skin.weights, skin.counts):
+        data += struct.pack('<i', count)
+        data += b''.join(struct.pack('<f', weight) for weight in weights[:count])
+        data += b''.join(struct.pack('<I', bone) for bone in bones[:count])
+    return data
+
+def test_lnk1_payload_bytes():
+    skin = random_skin(300)
+    assert len(set(skin.counts.tolist())) > 1
+    assert block_bytes(k2_skin.lnk1_payload(skin, 5)) == reference_lnk1(skin, 5)
+
+def test_lnk1_payload_round_trip():
+    # Mixed counts go through the per-vertex path, equal counts through the table path
+    mixed = random_skin(300)
+    for skin in (mixed, k2_skin.take(mixed, np.flatnonzero(mixed.counts == 4))):
+        verts, weights, indexes = k2_decode.decode_links(block_bytes(k2_skin.lnk1_payload(skin, 0)))
+        np.testing.assert_array_equal(np.bincount(verts, minlength=len(skin.counts)), skin.counts)
+        used = np.arange(skin.bones.shape[1]) < skin.counts[:, None]
+        np.testing.assert_array_equal(weights, skin.weights[used])
+        np.testing.assert_array_equal(indexes, skin.bones[used])
+
+def test_lnk1_payload_without_skin():
+    header, words = k2_skin.lnk1_payload(None, 2)
+    assert header == struct.pack('<ii', 2, 0)
+    assert len(words) == 0
+
+##############################
+# SURF
+##############################
+
+CUBE_POINTS = [(x, y, z) for x in (-1.0, 1.0) for y in (-1.0, 1.0) for z in (-1.0, 1.0)]
+CUBE_TRIS = [(0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1),
+             (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3)]
+
+def test_surf_payload_round_trip():
+    tables = k2_surf.surf_tables(CUBE_POINTS, CUBE_TRIS)
+    payload = block_bytes(k2_surf.surf_payload(tables, 3, flags=1))
+    assert k2_decode.decode_surf_header(payload) == (3, 6, 8, 12, 12)
+    assert struct.unpack_from('<6fi', payload, 20) == (-1.0, -1.0, -1.0, 1.0, 1.0, 1.0, 1)
+    for decoded, table in zip(k2_decode.decode_surf(payload), tables):
+        np.testing.assert_array_equal(decoded, table)
+    assert len(payload) == 20 + 28 + 6 * 16 + 8 * 12 + 12 * 24 + 12 * 12
+
+##############################
+# SYNTHETIC FILES
+##############################
+
+def test_synth_model_blocks(tmp_path):
+    path = k2_synth.write_model(str(tmp_path / 'synth.model'), num_verts=500, num_meshes=1, num_bones=4)
+    with k2_decode.ChunkFile(path) as model:
+        sizes = {entry.tag: entry.size for entry in model.chunks}
+        head = k2_decode.decode_head(model.chunk(model.chunks[0]))
+        verts = k2_decode.decode_vertices(model.chunk(model.find(b'vrts')).view)
+    num_verts = len(verts)
+    assert sizes[b'vrts'] == sizes[b'nrml'] == 4 + 12 * num_verts
+    assert sizes[b'tang'] == 8 + 12 * num_verts
+    assert sizes[b'texc'] == 8 + 8 * num_verts
+    assert sizes[b'sign'] == 8 + num_verts
+    assert sizes[b'lnk1'] == 8 + num_verts * (1 + 2 * 4) * 4
+    assert (head.num_meshes, head.num_bones) == (1, 4)
+    np.testing.assert_array_less(np.array(head.bbox[:3]) - 1e-6, verts.min(axis=0))
+
+##############################
+# EXPORTER BLOCKS (needs bpy)
+##############################
+
+@pytest.fixture(scope='module')
+def addon():
+    pytest.importorskip('bpy')
+    import k2_batch
+    return k2_batch.load_addon()
+
+def written_block(k2_export, tag, payload):
+    file = BytesIO()
+    file.write(b'XXXX')
+    k2_export.write_block(file, tag, payload)
+    assert file.tell() == len(file.getvalue())
+    return file.getvalue()[4:]
+
+def expected_block(tag, data):
+    return tag + struct.pack('<i', len(data)) + data
+
+def test_write_block_bytes(addon):
+    k2_export = addon[1]
+    rng = np.random.default_rng(0)
+    co = rng.normal(size=(50, 3)).astype(np.float32)
+    uv = rng.random((50, 2)).astype(np.float32)
+    signs = rng.choice(np.array([-1, 1], dtype=np.int8), 50)
+    colors = rng.integers(0, 256, (50, 4)).astype(np.uint8)
+    skin = random_skin(50)
+
+    def pack_rows(fmt, rows):
+        return b''.join(struct.pack(fmt, *row) for row in rows.tolist())
+
+    cases = [
+        ('vrts', k2_export.create_vrts_data(co, 1), struct.pack('<i', 1) + pack_rows('<3f', co)),
+        ('nrml', k2_export.create_nrml_data(co, 1), struct.pack('<i', 1) + pack_rows('<3f', co)),
+        ('tang', k2_export.create_tang_data(co, 1), struct.pack('<ii', 1, 0) + pack_rows('<3f', co)),
+        ('texc', k2_export.create_texc_data(uv, 1),
+         struct.pack('<ii', 1, 0) + b''.join(struct.pack('<2f', u, 1.0 - v) for u, v in uv.tolist())),
+        ('sign', k2_export.create_sign_data(1, signs), struct.pack('<ii', 1, 0) + pack_rows('<b', signs[:, None])),
+        ('colr', k2_export.create_colr_data(colors, 1), struct.pack('<i', 1) + pack_rows('<4B', colors)),
+        ('lnk1', k2_export.create_lnk1_data(skin, 1), reference_lnk1(skin, 1)),
+        ('head', struct.pack('<3i', 2, 3, 4), struct.pack('<3i', 2, 3, 4)),
+    ]
+    for nverts, fmt in ((200, '<3B'), (60000, '<3H'), (70000, '<3I')):
+        faces = rng.integers(0, min(nverts, 255), (40, 3))
+        cases.append(('face', k2_export.create_face_data(nverts, faces, 1),
+                      struct.pack('<iiB', 1, 40, struct.calcsize(fmt) // 3) + pack_rows(fmt, faces)))
+    for tag, payload, data in cases:
+        assert written_block(k2_export, tag, payload) == expected_block(tag.encode('utf8'), data), tag
+
+def test_export_round_trip(addon, tmp_path):
+    import k2_batch
+    k2_import, k2_export = addon
+    src = k2_synth.write_model(str(tmp_path / 'src.model'), num_verts=800, num_meshes=2, num_bones=8, influences=2)
+    dst = str(tmp_path / 'out' / 'dst.model')
+    k2_batch.convert_model(k2_import, k2_export, src, dst)
+    with k2_decode.ChunkFile(src) as model:
+        before = k2_decode.decode_model(model)
+    with k2_decode.ChunkFile(dst) as model:
+        after = k2_decode.decode_model(model)
+    assert after.header.num_meshes == before.header.num_meshes
+    assert after.bones.names == before.bones.names
+    for old, new in zip(before.meshes, sorted(after.meshes, key=lambda mesh: mesh.name)):
+        assert len(new.verts) == len(old.verts)
+        assert len(new.faces) == len(old.faces)
+        assert sum(len(verts) for _, verts, _ in new.links) == sum(len(verts) for _, verts, _ in old.links)